@@ -5,6 +5,7 @@ import sys
 import os
 import glob
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from os.path import exists
 from pathlib import Path
 from scripts.images import Images
@@ -13,66 +14,102 @@ from scripts.prompts import Prompts
 from scripts.archive import Archive
 from scripts.config import Config
 
+# file extensions recognized as downloadable resources
+RESOURCE_EXTS = frozenset({'.safetensors', '.ckpt', '.pt'})
+
 # gets resources found within specified dir and all sub-dirs
+# prefers os.fwalk (POSIX-only) so each subdir is opened once and stats go
+# through *at() syscalls against the dir fd; on Windows falls back to an
+# explicit os.scandir stack, which re-uses the dirent info from readdir
+# so we avoid an extra stat call per entry
 def get_resources_from_tree(root_dir):
-    resources = []
-    for root, dirs, files in os.walk(root_dir, topdown=False):
-        for name in files:
-            if (name.lower().endswith('.safetensors') or
-                name.lower().endswith('.ckpt') or
-                name.lower().endswith('.pt')):
-                full_file_path = os.path.join(root, name)
-                resources.append(name)
-        for name in dirs:
-            full_dir_path = os.path.join(root, name)
-    resources = list(set(resources))
-    resources.sort()
-    return resources
-
-# handles creation/backup of logfile
+    # unset/missing paths would otherwise walk the current dir and treat
+    # stray local files as existing resources
+    if not root_dir or not os.path.isdir(root_dir):
+        return frozenset()
+    resources = set()
+    if hasattr(os, 'fwalk'):
+        for root, dirs, files, dirfd in os.fwalk(root_dir):
+            for name in files:
+                # rfind slice is cheaper than lowercasing the whole name
+                if name[name.rfind('.'):].lower() in RESOURCE_EXTS:
+                    resources.add(name)
+    else:
+        stack = [root_dir]
+        while stack:
+            dir = stack.pop()
+            # skip unreadable/vanished subdirs like os.walk did
+            try:
+                it = os.scandir(dir)
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks = False):
+                        stack.append(entry.path)
+                    elif entry.name[entry.name.rfind('.'):].lower() in RESOURCE_EXTS:
+                        resources.add(entry.name)
+    # callers only test membership, so return a frozenset for O(1) lookups
+    return frozenset(resources)
+
+# handles creation/backup of logfile; returns an open append-mode handle
+# that's re-used for all writes instead of re-opening the file per line
 def create_logfile(file):
-    logfile = file
     os.makedirs('logs', exist_ok = True)
-    if exists(logfile + '.bak'):
-        os.remove(logfile + '.bak')
-    if exists(logfile):
-        os.rename(logfile, logfile + '.bak')
+    if exists(file):
+        # os.replace overwrites any existing .bak atomically
+        os.replace(file, file + '.bak')
+    return open(file, 'a', encoding="utf-8", buffering = 64*1024)
 
 # logs to file/console
+# file is the open log file handle returned by create_logfile
 def log(file, line, console = True):
-    logfile = file
     if console:
         print(line)
     output = '[Main] > ' + str(line)
-    with open(logfile, 'a', encoding="utf-8") as f:
-        f.write(output.replace('\n', '') + '\n')
+    file.write(output.replace('\n', '') + '\n')
+    if console:
+        file.flush()
 
 # downloads missing resources
 # missing_dict: dictionary of missing items (key = version id, val = images.ImageResources)
 # descriptor: plural text to display in log describing what we're downloading (e.g. loras, embeddings, etc)
 # download_location: where to save downloaded files
-def download_resources(missing_dict, descriptor, download_location):
+# downloads run in parallel (capped at a few workers to be kind to the server);
+# the Network class still enforces the minimum delay between request starts
+def download_resources(missing_dict, descriptor, download_location, max_workers = 4):
     if download_location != '':
         if len(missing_dict) > 0:
             log(logfile, '\nDownloading missing ' + descriptor + '...')
         count = 0
-        for k, v in missing_dict.items():
-            count += 1
-            log(logfile, '  [' + str(count) + ' of ' + str(len(missing_dict)) + '] Attempting to download ' + v.filename + '...')
-            network.download_file('https://civitai.com/api/download/models/' + str(k), download_location, v.filename)
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            futures = {}
+            for k, v in missing_dict.items():
+                url = 'https://civitai.com/api/download/models/' + str(k)
+                # pre-check the file size via HEAD so oversize files never open a full GET
+                if network.max_file_size > 0:
+                    size = network.check_size(url)
+                    if size is not None and size > network.max_file_size:
+                        log(logfile, '  Skipping ' + v.filename + ' (' + str(size) + ' bytes is over the maximum file size limit of ' + str(network.max_file_size) + ' bytes)...')
+                        network.block(k)
+                        continue
+                log(logfile, '  Queueing download of ' + v.filename + '...', False)
+                futures[executor.submit(network.download_file, url, download_location, v.filename)] = v
+            for future in as_completed(futures):
+                count += 1
+                log(logfile, '  [' + str(count) + ' of ' + str(len(futures)) + '] Finished download attempt for ' + futures[future].filename + '...')
     else:
         log(logfile, '\nDownload location not specified for ' + descriptor + '; no resources of this type will be downloaded!')
 
 # entry point
 if __name__ == '__main__':
-    logfile = os.path.join('logs', 'log.txt')
-    create_logfile(logfile)
+    logfile = create_logfile(os.path.join('logs', 'log.txt'))
     log(logfile, '\nStarting..\n')
 
     config = Config(argparse.ArgumentParser())
     #config.debug_display_user_options()
 
-    if config.image_config.get('path') == '':
+    if config.image_path == '':
         print('Error: no image path specified; aborting!')
         print('(Start with --help for help; must specify image path on command line or via config file)')
         exit(0)
@@ -97,38 +134,35 @@ if __name__ == '__main__':
     prompts.write_prompt_file()
 
     log(logfile, '\nComparing referenced resources to existing local resources...')
-    existing_loras = get_resources_from_tree(config.general_config.get('existing_lora_path'))
-    existing_embeds = get_resources_from_tree(config.general_config.get('existing_embedding_path'))
-    existing_checkpoints = get_resources_from_tree(config.general_config.get('existing_model_path'))
+    # the three trees are independent, so walk them in parallel; the GIL is
+    # released during the underlying syscalls
+    with ThreadPoolExecutor(max_workers = 3) as executor:
+        f_loras = executor.submit(get_resources_from_tree, config.existing_lora_path)
+        f_embeds = executor.submit(get_resources_from_tree, config.existing_embedding_path)
+        f_checkpoints = executor.submit(get_resources_from_tree, config.existing_model_path)
+        existing_loras = f_loras.result()
+        existing_embeds = f_embeds.result()
+        existing_checkpoints = f_checkpoints.result()
 
     referenced_loras = prompts.get_referenced_resources('lora')
     referenced_embeds = prompts.get_referenced_resources('embed')
     referenced_checkpoints = prompts.get_referenced_resources(['model', 'checkpoint'])
 
-    missing_loras = {}
-    for k, v in referenced_loras.items():
-        if v.filename not in existing_loras:
-            if k not in network.do_not_download:
-                missing_loras[k] = v
-
-    missing_embeds = {}
-    for k, v in referenced_embeds.items():
-        if v.filename not in existing_embeds:
-            if k not in network.do_not_download:
-                missing_embeds[k] = v
-
-    missing_checkpoints = {}
-    for k, v in referenced_checkpoints.items():
-        if v.filename not in existing_checkpoints:
-            if k not in network.do_not_download:
-                missing_checkpoints[k] = v
+    # (log label, plural descriptor, referenced resources, existing local files, download path option)
+    kinds = [
+        ('embeddings(s)', 'embeddings', referenced_embeds, existing_embeds, 'download_embedding_path'),
+        ('LoRA(s)', 'LoRAs', referenced_loras, existing_loras, 'download_lora_path'),
+        ('model(s)', 'models', referenced_checkpoints, existing_checkpoints, 'download_model_path')
+    ]
 
-    log(logfile, '  ' + str(len(missing_embeds)) + ' referenced embeddings(s) don\'t exist locally and need to be downloaded.')
-    log(logfile, '  ' + str(len(missing_loras)) + ' referenced LoRA(s) don\'t exist locally and need to be downloaded.')
-    log(logfile, '  ' + str(len(missing_checkpoints)) + ' referenced model(s) don\'t exist locally and need to be downloaded.')
+    missing = {}
+    for label, descriptor, referenced, existing, path_key in kinds:
+        missing[descriptor] = {k : v for k, v in referenced.items()
+            if v.filename not in existing and not network.is_blocked(k)}
+        log(logfile, '  ' + str(len(missing[descriptor])) + ' referenced ' + label + ' don\'t exist locally and need to be downloaded.')
 
-    download_resources(missing_embeds, 'embeddings', config.general_config.get('download_embedding_path'))
-    download_resources(missing_loras, 'LoRAs', config.general_config.get('download_lora_path'))
-    download_resources(missing_checkpoints, 'models', config.general_config.get('download_model_path'))
+    for label, descriptor, referenced, existing, path_key in kinds:
+        download_resources(missing[descriptor], descriptor, getattr(config, path_key))
 
     log(logfile, '\nDone!')
+    logfile.close()
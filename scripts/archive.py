@@ -7,6 +7,7 @@ import re
 import os
 import shlex
 import glob
+from collections import defaultdict
 from tqdm.auto import tqdm
 from os.path import exists
 from pathlib import Path
@@ -18,8 +19,13 @@ class Archive:
     def __init__(self, image_metadata, config):
         self.logfile = os.path.join('logs', 'log.txt')
         os.makedirs('logs', exist_ok = True)
+        # keep a single append-mode handle open instead of re-opening per log line
+        self._logf = open(self.logfile, 'a', encoding="utf-8", buffering = 64*1024)
 
         self.metadata = image_metadata
+        # base model names normalized once up front; archiving passes re-use
+        # these instead of re-running .lower().strip() per item per pass
+        self._bases = {k : (v.base_model or '').lower().strip() for k, v in self.metadata.items()}
 
         self.archive_location = 'E:\Art\archive\Civitai'
         self.move_images = True
@@ -38,75 +44,72 @@ class Archive:
     def handle_rename_images(self):
         self.log('Renaming images...')
 
-        # sort by base model
-        models = []
+        # bucket metadata by base model in a single pass
+        buckets = defaultdict(list)
         for k, v in self.metadata.items():
-            if v.base_model.lower().strip() not in models:
-                models.append(v.base_model.lower().strip())
-        models.sort()
+            base = self._bases.get(k, '')
+            if base == '':
+                base = 'unknown_base'
+            buckets[base].append(v)
 
         # rename each file in format [date]_[base_model]_[#####].ext
-        for m in models:
+        date = dt.now().strftime('%Y-%m-%d')
+        for base, items in sorted(buckets.items()):
             model_count = 0
-            for k, v in self.metadata.items():
-                if v.base_model.lower().strip() == m:
-                    orig_path = os.path.join(v.orig_filepath, v.orig_filename)
-                    base = v.base_model.lower().strip()
-                    if base == '':
-                        base = 'unknown_base'
-
-                    new_filename = dt.now().strftime('%Y-%m-%d') + '_' + base
-                    ext = '.jpg'
-                    if v.orig_filename.lower().endswith('.png'):
-                        ext = '.png'
-
-                    new_filename += '_' + str(model_count).zfill(5) + ext
+            for v in items:
+                orig_path = os.path.join(v.orig_filepath, v.orig_filename)
+
+                new_filename = date + '_' + base
+                ext = '.jpg'
+                if v.orig_filename.lower().endswith('.png'):
+                    ext = '.png'
+
+                new_filename += '_' + str(model_count).zfill(5) + ext
+                new_path = os.path.join(v.orig_filepath, new_filename)
+
+                # if the target name is taken (e.g. same-day re-run), find another
+                # valid filename instead of relying on rename to fail; a file
+                # already at its correct name isn't a collision (renaming it
+                # onto itself is a no-op, keeping re-runs idempotent)
+                if new_path != orig_path and exists(new_path):
+                    new_filename = self.find_available_filename(v.orig_filepath, date + '_' + base, ext)
                     new_path = os.path.join(v.orig_filepath, new_filename)
 
-                    # try to rename, if error try to find another valid filename
-                    try:
-                        os.rename(orig_path, new_path)
-                    except:
-                        try:
-                            new_filename = self.find_available_filename(v.orig_filepath, dt.now().strftime('%Y-%m-%d') + '_' + base, ext)
-                            os.rename(orig_path, new_path)
-                        except Exception as e:
-                            self.log('Error: Unable to rename ' + v.orig_filename + ': ' + str(e))
-                        else:
-                            self.log('Renamed ' + v.orig_filename + ' to ' + new_filename + '...', self.log_to_console)
-                            v.orig_filename = new_filename
-                            model_count += 1
-                    else:
-                        self.log('Renamed ' + v.orig_filename + ' to ' + new_filename + '...', self.log_to_console)
-                        v.orig_filename = new_filename
-                        model_count += 1
+                # os.replace is atomic & avoids Windows EEXIST failures
+                try:
+                    os.replace(orig_path, new_path)
+                except Exception as e:
+                    self.log('Error: Unable to rename ' + v.orig_filename + ': ' + str(e))
+                else:
+                    self.log('Renamed ' + v.orig_filename + ' to ' + new_filename + '...', self.log_to_console)
+                    v.orig_filename = new_filename
+                    model_count += 1
 
 
     # finds a valid filename that isn't currently in-use
     def find_available_filename(self, path, filename, ext):
+        # sanitize once; only the counter changes between attempts
+        base = utils.sanitize_filename(filename)
         count = 0
-        fn = utils.sanitize_filename(filename) + '_' + str(count).zfill(5) + ext
+        fn = f'{base}_{count:05d}{ext}'
         while exists(os.path.join(path, fn)):
             count += 1
-            fn = utils.sanitize_filename(filename) + '_' + str(count).zfill(5) + ext
+            fn = f'{base}_{count:05d}{ext}'
         return fn
 
 
     # re-orders the metadata so that models are grouped together
     def order_by_model(self):
         self.log('Ordering prompts by model...')
-        models = []
+        # bucket keys by model in a single pass, then rebuild in sorted order
+        buckets = defaultdict(list)
         for k, v in self.metadata.items():
-            if v.model.lower().strip() not in models:
-                models.append(v.model.lower().strip())
-        models.sort()
+            buckets[v.model.lower().strip()].append(k)
 
-        # for each model,
         ordered_metadata = {}
-        for m in models:
-            for k, v in self.metadata.items():
-                if v.model.lower().strip() == m:
-                    ordered_metadata[k] = v
+        for m, keys in sorted(buckets.items()):
+            for k in keys:
+                ordered_metadata[k] = self.metadata[k]
 
         #print('original count: ' + str(len(self.metadata.items())))
         #print('sorted count: ' + str(len(ordered_metadata.items())))
@@ -122,5 +125,14 @@ class Archive:
         output = '[Archive] > ' + str(line)
         if console:
             print(output)
-        with open(self.logfile, 'a', encoding="utf-8") as f:
-            f.write(output + '\n')
+        self._logf.write(output + '\n')
+        if console:
+            self._logf.flush()
+
+    # flushes & closes the log file handle
+    def close(self):
+        if not self._logf.closed:
+            self._logf.close()
+
+    def __del__(self):
+        self.close()
@@ -7,7 +7,6 @@ import glob
 import argparse
 from os.path import exists
 from pathlib import Path
-from scripts.utils import TextFile
 
 # Handles all configuration options
 # options specified in config file are overridden by options also specified on command line
@@ -15,6 +14,8 @@ class Config:
     def __init__(self, ap):
         self.logfile = os.path.join('logs', 'log.txt')
         os.makedirs('logs', exist_ok = True)
+        # keep a single append-mode handle open instead of re-opening per log line
+        self._logf = open(self.logfile, 'a', encoding="utf-8", buffering = 64*1024)
 
         # user options are populated here
         self.general_config = {}
@@ -37,6 +38,16 @@ class Config:
         # (will override config file options)
         self.init_command_line()
 
+        # pre-resolve frequently-read options into plain attributes so hot
+        # call sites don't pay a dict lookup on every read
+        self.image_path = self.image_config.get('path', '')
+        self.existing_model_path = self.general_config.get('existing_model_path', '')
+        self.existing_lora_path = self.general_config.get('existing_lora_path', '')
+        self.existing_embedding_path = self.general_config.get('existing_embedding_path', '')
+        self.download_model_path = self.general_config.get('download_model_path', '')
+        self.download_lora_path = self.general_config.get('download_lora_path', '')
+        self.download_embedding_path = self.general_config.get('download_embedding_path', '')
+
 
     # for debugging, displays all user options
     def debug_display_user_options(self):
@@ -55,67 +66,48 @@ class Config:
             self.log('  ' + str(k) + ' : ' + str(v))
         print('')
 
+    # returns a table mapping each option to where it lives:
+    # (target dict, config key, argparse attribute, argparse default)
+    def option_schema(self):
+        return [
+            # network params
+            (self.network_config, 'api_key', 'civitai_api_key', ''),
+            (self.network_config, 'request_delay', 'civitai_request_delay', 1),
+            (self.network_config, 'max_file_size', 'civitai_max_file_size', 1000000000),
+            # image params
+            (self.image_config, 'path', 'image_path', ''),
+            (self.image_config, 'path_ignore_subdirs', 'image_path_ignore_subdirs', False),
+            # prompt params
+            (self.prompt_config, 'append_filename', 'prompt_append_filename', ''),
+            (self.prompt_config, 'min_steps', 'prompt_min_steps', 0),
+            (self.prompt_config, 'max_steps', 'prompt_max_steps', 0),
+            (self.prompt_config, 'min_scale', 'prompt_min_scale', 0),
+            (self.prompt_config, 'max_scale', 'prompt_max_scale', 0),
+            (self.prompt_config, 'fix_resolution', 'prompt_fix_resolution', True),
+            (self.prompt_config, 'only_include_base', 'prompt_only_include_base', ''),
+            (self.prompt_config, 'output_template', 'prompt_output_template', ''),
+            (self.prompt_config, 'output_header', 'prompt_output_header', ''),
+            (self.prompt_config, 'output_footer', 'prompt_output_footer', ''),
+            (self.prompt_config, 'output_save_as', 'prompt_output_save_as', ''),
+            (self.prompt_config, 'word_filter_list', 'prompt_word_filter_list', ''),
+            (self.prompt_config, 'neg_word_filter_list', 'prompt_neg_word_filter_list', ''),
+            (self.prompt_config, 'lora_filter_list', 'prompt_lora_filter_list', ''),
+            # general params
+            (self.general_config, 'existing_model_path', 'existing_model_path', ''),
+            (self.general_config, 'existing_lora_path', 'existing_lora_path', ''),
+            (self.general_config, 'existing_embedding_path', 'existing_embedding_path', ''),
+            (self.general_config, 'download_model_path', 'download_model_path', ''),
+            (self.general_config, 'download_lora_path', 'download_lora_path', ''),
+            (self.general_config, 'download_embedding_path', 'download_embedding_path', '')
+        ]
+
     # handles committing options from user-supplied command-line arguments
     # only add if they're not already present (from config file) or not a default value
     def init_command_line(self):
-        # network params
-        if ('api_key' not in self.network_config) or (self.options.civitai_api_key != ''):
-            self.network_config.update({'api_key' : self.options.civitai_api_key})
-        if ('request_delay' not in self.network_config) or (self.options.civitai_request_delay != 1):
-            self.network_config.update({'request_delay' : self.options.civitai_request_delay})
-        if ('max_file_size' not in self.network_config) or (self.options.civitai_max_file_size != 1000000000):
-            self.network_config.update({'max_file_size' : self.options.civitai_max_file_size})
-
-        # image params
-        if ('path' not in self.image_config) or (self.options.image_path != ''):
-            self.image_config.update({'path' : self.options.image_path})
-        if ('path_ignore_subdirs' not in self.image_config) or (self.options.image_path_ignore_subdirs != False):
-            self.image_config.update({'path_ignore_subdirs' : self.options.image_path_ignore_subdirs})
-
-        # prompt params
-        if ('append_filename' not in self.prompt_config) or (self.options.prompt_append_filename != ''):
-            self.prompt_config.update({'append_filename' : self.options.prompt_append_filename})
-        if ('min_steps' not in self.prompt_config) or (self.options.prompt_min_steps != 0):
-            self.prompt_config.update({'min_steps' : self.options.prompt_min_steps})
-        if ('max_steps' not in self.prompt_config) or (self.options.prompt_max_steps != 0):
-            self.prompt_config.update({'max_steps' : self.options.prompt_max_steps})
-        if ('min_scale' not in self.prompt_config) or (self.options.prompt_min_scale != 0):
-            self.prompt_config.update({'min_scale' : self.options.prompt_min_scale})
-        if ('max_scale' not in self.prompt_config) or (self.options.prompt_max_scale != 0):
-            self.prompt_config.update({'max_scale' : self.options.prompt_max_scale})
-        if ('fix_resolution' not in self.prompt_config) or (self.options.prompt_fix_resolution != True):
-            self.prompt_config.update({'fix_resolution' : self.options.prompt_fix_resolution})
-
-        if ('only_include_base' not in self.prompt_config) or (self.options.prompt_only_include_base != ''):
-            self.prompt_config.update({'only_include_base' : self.options.prompt_only_include_base})
-        if ('output_template' not in self.prompt_config) or (self.options.prompt_output_template != ''):
-            self.prompt_config.update({'output_template' : self.options.prompt_output_template})
-        if ('output_header' not in self.prompt_config) or (self.options.prompt_output_header != ''):
-            self.prompt_config.update({'output_header' : self.options.prompt_output_header})
-        if ('output_footer' not in self.prompt_config) or (self.options.prompt_output_footer != ''):
-            self.prompt_config.update({'output_footer' : self.options.prompt_output_footer})
-        if ('output_save_as' not in self.prompt_config) or (self.options.prompt_output_save_as != ''):
-            self.prompt_config.update({'output_save_as' : self.options.prompt_output_save_as})
-        if ('word_filter_list' not in self.prompt_config) or (self.options.prompt_word_filter_list != ''):
-            self.prompt_config.update({'word_filter_list' : self.options.prompt_word_filter_list})
-        if ('neg_word_filter_list' not in self.prompt_config) or (self.options.prompt_neg_word_filter_list != ''):
-            self.prompt_config.update({'neg_word_filter_list' : self.options.prompt_neg_word_filter_list})
-        if ('lora_filter_list' not in self.prompt_config) or (self.options.prompt_lora_filter_list != ''):
-            self.prompt_config.update({'lora_filter_list' : self.options.prompt_lora_filter_list})
-
-        # general params
-        if ('existing_model_path' not in self.general_config) or (self.options.existing_model_path != ''):
-            self.general_config.update({'existing_model_path' : self.options.existing_model_path})
-        if ('existing_lora_path' not in self.general_config) or (self.options.existing_lora_path != ''):
-            self.general_config.update({'existing_lora_path' : self.options.existing_lora_path})
-        if ('existing_embedding_path' not in self.general_config) or (self.options.existing_embedding_path != ''):
-            self.general_config.update({'existing_embedding_path' : self.options.existing_embedding_path})
-        if ('download_model_path' not in self.general_config) or (self.options.download_model_path != ''):
-            self.general_config.update({'download_model_path' : self.options.download_model_path})
-        if ('download_lora_path' not in self.general_config) or (self.options.download_lora_path != ''):
-            self.general_config.update({'download_lora_path' : self.options.download_lora_path})
-        if ('download_embedding_path' not in self.general_config) or (self.options.download_embedding_path != ''):
-            self.general_config.update({'download_embedding_path' : self.options.download_embedding_path})
+        for d, key, attr, default in self.option_schema():
+            value = getattr(self.options, attr)
+            if (key not in d) or (value != default):
+                d.update({key : value})
 
 
     # handles reading options from user-supplied command-line arguments
@@ -286,151 +278,51 @@ class Config:
             self.log('Error: specified config file ' + config_file + ' does not exist; using defaults instead!')
             return None
 
-        file = TextFile(config_file)
-        if file.lines_remaining() > 0:
-            self.log("Reading configuration from " + config_file + "...")
-            while file.lines_remaining() > 0:
-                line = file.next_line()
-
-                # update config values for found directives
-                if '=' in line:
-                    line = line.split('=', 1)
-                    command = line[0].lower().strip()
-                    value = line[1].strip()
-
-                    if command == 'civitai_api_key':
-                        if value != '':
-                            self.network_config.update({'api_key' : value})
-
-                    elif command == 'civitai_request_delay':
-                        if value != '':
-                            try:
-                                float(value)
-                            except:
-                                pass
-                            else:
-                                self.network_config.update({'request_delay' : float(value)})
-
-                    elif command == 'civitai_max_file_size':
-                        if value != '':
-                            try:
-                                int(value)
-                            except:
-                                pass
-                            else:
-                                self.network_config.update({'max_file_size' : int(value)})
-
-                    elif command == 'image_path':
-                        if value != '':
-                            self.image_config.update({'path' : value})
-
-                    elif command == 'image_path_ignore_subdirs':
-                        if value == 'yes' or value == 'true':
-                            self.image_config.update({'path_ignore_subdirs' : True})
-                        elif value == 'no' or value == 'false':
-                            self.image_config.update({'path_ignore_subdirs' : False})
-
-                    elif command == 'prompt_append_filename':
-                        if value != '':
-                            self.prompt_config.update({'append_filename' : value})
-
-                    elif command == 'prompt_min_steps':
-                        if value != '':
-                            try:
-                                int(value)
-                            except:
-                                pass
-                            else:
-                                self.prompt_config.update({'min_steps' : int(value)})
-
-                    elif command == 'prompt_max_steps':
-                        if value != '':
-                            try:
-                                int(value)
-                            except:
-                                pass
-                            else:
-                                self.prompt_config.update({'max_steps' : int(value)})
+        # config file directives that need casting from their string values;
+        # everything else in the schema is committed as a plain string
+        casts = {
+            'civitai_request_delay' : float,
+            'civitai_max_file_size' : int,
+            'prompt_min_steps' : int,
+            'prompt_max_steps' : int,
+            'prompt_min_scale' : float,
+            'prompt_max_scale' : float,
+            'image_path_ignore_subdirs' : bool,
+            'prompt_fix_resolution' : bool
+        }
+        dispatch = {}
+        for d, key, attr, default in self.option_schema():
+            dispatch[attr] = (d, key, casts.get(attr, str))
+
+        try:
+            lines = Path(config_file).read_text(encoding = 'utf-8').splitlines()
+        except OSError:
+            self.log('Error: unable to read config file ' + config_file + '; using defaults instead!')
+            return None
 
-                    elif command == 'prompt_min_scale':
-                        if value != '':
-                            try:
-                                float(value)
-                            except:
-                                pass
-                            else:
-                                self.prompt_config.update({'min_scale' : float(value)})
+        self.log("Reading configuration from " + config_file + "...")
+        for line in lines:
+            # remove comments and whitespace
+            line = line.split('#', 1)[0].strip()
 
-                    elif command == 'prompt_max_scale':
-                        if value != '':
-                            try:
-                                float(value)
-                            except:
-                                pass
-                            else:
-                                self.prompt_config.update({'max_scale' : float(value)})
+            # update config values for found directives
+            if '=' in line:
+                line = line.split('=', 1)
+                command = line[0].lower().strip()
+                value = line[1].strip()
 
-                    elif command == 'prompt_fix_resolution':
+                if command in dispatch:
+                    d, key, cast = dispatch[command]
+                    if cast is bool:
                         if value == 'yes' or value == 'true':
-                            self.prompt_config.update({'fix_resolution' : True})
+                            d.update({key : True})
                         elif value == 'no' or value == 'false':
-                            self.prompt_config.update({'fix_resolution' : False})
-
-                    elif command == 'prompt_only_include_base':
-                        if value != '':
-                            self.prompt_config.update({'only_include_base' : value})
-
-                    elif command == 'prompt_output_template':
-                        if value != '':
-                            self.prompt_config.update({'output_template' : value})
-
-                    elif command == 'prompt_output_header':
-                        if value != '':
-                            self.prompt_config.update({'output_header' : value})
-
-                    elif command == 'prompt_output_footer':
-                        if value != '':
-                            self.prompt_config.update({'output_footer' : value})
-
-                    elif command == 'prompt_output_save_as':
-                        if value != '':
-                            self.prompt_config.update({'output_save_as' : value})
-
-                    elif command == 'prompt_word_filter_list':
-                        if value != '':
-                            self.prompt_config.update({'word_filter_list' : value})
-
-                    elif command == 'prompt_neg_word_filter_list':
-                        if value != '':
-                            self.prompt_config.update({'neg_word_filter_list' : value})
-
-                    elif command == 'prompt_lora_filter_list':
-                        if value != '':
-                            self.prompt_config.update({'lora_filter_list' : value})
-
-                    elif command == 'existing_model_path':
-                        if value != '':
-                            self.general_config.update({'existing_model_path' : value})
-
-                    elif command == 'existing_lora_path':
-                        if value != '':
-                            self.general_config.update({'existing_lora_path' : value})
-
-                    elif command == 'existing_embedding_path':
-                        if value != '':
-                            self.general_config.update({'existing_embedding_path' : value})
-
-                    elif command == 'download_model_path':
-                        if value != '':
-                            self.general_config.update({'download_model_path' : value})
-
-                    elif command == 'download_lora_path':
-                        if value != '':
-                            self.general_config.update({'download_lora_path' : value})
-
-                    elif command == 'download_embedding_path':
-                        if value != '':
-                            self.general_config.update({'download_embedding_path' : value})
+                            d.update({key : False})
+                    elif value != '':
+                        try:
+                            d.update({key : cast(value)})
+                        except ValueError:
+                            pass
 
 
     # handles logging to file/console
@@ -438,5 +330,14 @@ class Config:
         output = '[Config] > ' + str(line)
         if console:
             print(output)
-        with open(self.logfile, 'a', encoding="utf-8") as f:
-            f.write(output + '\n')
+        self._logf.write(output + '\n')
+        if console:
+            self._logf.flush()
+
+    # flushes & closes the log file handle
+    def close(self):
+        if not self._logf.closed:
+            self._logf.close()
+
+    def __del__(self):
+        self.close()
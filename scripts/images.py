@@ -7,8 +7,17 @@ import re
 import os
 import shlex
 import glob
+import threading
 import requests
-import json
+import csv
+# orjson (if installed) parses large ComfyUI workflows several times faster
+# than the stdlib parser; fall back to stdlib json when it's unavailable
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from tqdm.auto import tqdm
 from os.path import exists
 from pathlib import Path
@@ -16,12 +25,80 @@ from PIL import Image, ExifTags
 from PIL.ExifTags import TAGS
 import scripts.utils as utils
 
+# translates raw civitai.com API types to the resource type names used in
+# image metadata; unlisted types pass through unchanged
+# Semi-complete list? :
+# LoCon, LORA, TextualInversion, Checkpoint, DoRA, VAE
+API_TYPE_MAP = {
+    'lora' : 'lora',
+    'locon' : 'lora',
+    'dora' : 'lora',
+    'textualinversion' : 'embed',
+    'checkpoint' : 'model',
+    'model' : 'model',
+    'vae' : 'vae'
+}
+
+# single-pass extraction of A1111-style 'Key: value,' generation parameters;
+# one case-insensitive scan in the regex engine replaces a stack of
+# per-key in/split passes over the same string
+# keys must start a line or follow a comma so that e.g. 'Variation seed'
+# and 'Hires steps' can't match as 'Seed'/'Steps'
+A1111_RE = re.compile(r'(?i)(?:^|(?<=[,\n]))\s*(Steps|CFG scale|Denoising strength|Size|Clip skip|Sampler|Seed|Model hash|Model):\s*([^,\n]+)')
+# maps lowercased parameter names to ImageMetaData attributes
+# (Size/Sampler/Model need extra handling and are dispatched separately)
+A1111_FIELDS = {
+    'steps' : 'steps',
+    'cfg scale' : 'scale',
+    'denoising strength' : 'strength',
+    'clip skip' : 'clip_skip',
+    'seed' : 'seed',
+    'model hash' : 'hash'
+}
+
+# one-pass extraction of '"type": "hash"' pairs from a 'Hashes: {...}' block
+HASHES_RE = re.compile(r'"([^"]+)"\s*:\s*"([^"]*)"')
+# one-pass extraction of 'name: hash' entries from a 'Lora hashes: "..."' block
+LORA_HASHES_RE = re.compile(r'([^:,\s]+)\s*:\s*([0-9a-fA-F]+)')
+
+# the caches now live on the utils functions themselves; these aliases keep
+# the shorter local names used throughout this module
+extract_model_filename = utils.extract_model_filename
+extract_model_hash = utils.extract_model_hash
+
+# returns True if the value can be interpreted as an int
+# a string check is 10-100x cheaper than raising/catching from int()
+def is_intable(value):
+    if isinstance(value, (int, float)):
+        return True
+    return isinstance(value, str) and value.strip().lstrip('-').isdigit()
+
+# (input key, ImageMetaData attribute, handler) table for ComfyUI workflow
+# nodes; each handler returns the value to assign, or None to skip it
+# ('resolution' needs to set two attributes and is handled outside the table)
+COMFY_FIELDS = (
+    ('text_positive', 'prompt', lambda v: utils.sanitize_prompt(v.strip()) if isinstance(v, str) else None),
+    ('text_negative', 'neg_prompt', lambda v: utils.sanitize_prompt(v.strip()) if isinstance(v, str) else None),
+    ('noise_seed', 'seed', lambda v: v if is_intable(v) else None),
+    # sampler/scheduler names repeat constantly across a catalog; interning
+    # keeps one shared str object per distinct name
+    ('sampler_name', 'sampler', lambda v: sys.intern(v) if isinstance(v, str) else None),
+    ('scheduler', 'scheduler', lambda v: sys.intern(v) if isinstance(v, str) else None),
+    ('steps', 'steps', lambda v: v if isinstance(v, int) else None),
+    ('guidance', 'scale', lambda v: v if isinstance(v, float) else None),
+    ('unet_name', 'model', lambda v: extract_model_filename(v) if isinstance(v, str) else None),
+    ('width', 'width', lambda v: v if is_intable(v) else None),
+    ('height', 'height', lambda v: v if is_intable(v) else None)
+)
+
 # Handles examining a folder tree, finding civitai.com images and extracting their metadata
 class Images:
     # config is a dict of options prepared by the Config class
     def __init__(self, config):
         self.logfile = os.path.join('logs', 'log.txt')
         os.makedirs('logs', exist_ok = True)
+        # keep a single append-mode handle open instead of re-opening per log line
+        self._logf = open(self.logfile, 'a', encoding="utf-8", buffering = 64*1024)
 
         # init civitai id/hash caches
         self.cache_id_file = os.path.join('cache', 'civitai_version_ids.txt')
@@ -30,6 +107,17 @@ class Images:
         self.cache_hash = {}
         os.makedirs('cache', exist_ok = True)
         self.init_caches()
+        # cache files stay open (buffered) for the Images lifetime instead of
+        # being re-opened per entry; the lock guards concurrent writes from
+        # the prefetch worker threads
+        self._cache_lock = threading.Lock()
+        self._cache_id_fp = open(self.cache_id_file, 'a', encoding="utf-8", buffering = 64*1024)
+        self._cache_hash_fp = open(self.cache_hash_file, 'a', encoding="utf-8", buffering = 64*1024)
+
+        # re-use one session for all civitai.com API calls so keep-alive
+        # connection pooling amortizes the TCP/TLS handshakes
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': 'civitai-companion'})
 
         self.log_to_console = False
         self.image_path = config.get('path')
@@ -61,6 +149,7 @@ class Images:
             for r in v.resources:
                 api_type = self.lookup_civitai_resource_type(r.version_id)
                 if api_type != '':
+                    # normalize once per resource
                     if r.type.lower().strip() == 'checkpoint':
                         r.type = 'model'
                     if r.type != api_type:
@@ -74,12 +163,11 @@ class Images:
         resources = {}
         # if a single resource was passed as a string instead of list, convert it
         if isinstance(types, str):
-            t = types
-            types = []
-            types.append(t)
+            types = [types]
         # make sure everything is lowercase without any whitespace padding
-        for t in types:
-            t = t.lower().strip()
+        # (the old loop rebound its local without writing back, so mixed-case
+        # inputs never matched); a set also makes the membership test O(1)
+        types = {t.lower().strip() for t in types}
 
         for k, v in self.metadata.items():
             for r in v.resources:
@@ -88,29 +176,52 @@ class Images:
         return resources
 
 
+    # pre-resolves all uncached hash/version ID lookups concurrently so that
+    # the synchronous resolve loop afterwards runs entirely from cache
+    # the civitai API calls are independent, so fan them out over a bounded
+    # pool of threads; each worker handles a distinct key
+    def prefetch_missing_metadata(self, max_workers = 10):
+        # unique hashes that need a version ID lookup
+        hashes = set()
+        for v in self.metadata.values():
+            for r in v.resources:
+                if r.filename == '' and r.version_id == '' and r.hash != '' and r.hash not in self.cache_hash:
+                    hashes.add(r.hash)
+        if len(hashes) > 0:
+            with ThreadPoolExecutor(max_workers = max_workers) as executor:
+                list(executor.map(self.lookup_civitai_id, hashes))
+
+        # unique version IDs that need a filename lookup
+        ids = set()
+        for v in self.metadata.values():
+            for r in v.resources:
+                if r.filename == '':
+                    vid = r.version_id
+                    if vid == '' and r.hash != '':
+                        vid = self.cache_hash.get(r.hash, '')
+                    if vid != '' and vid not in self.cache_id:
+                        ids.add(vid)
+        if len(ids) > 0:
+            with ThreadPoolExecutor(max_workers = max_workers) as executor:
+                list(executor.map(self.lookup_civitai_filename, ids))
+
     # checks the local cache and then makes necessary API calls to civitai.com
     # to fill in any essential (model version ID) missing metadata
     def lookup_missing_metadata(self):
         if len(self.metadata) > 0:
             self.log('Querying civitai.com for missing info in images containing metadata...')
-        for k, v in tqdm(self.metadata.copy().items()):
-            md = v
+        self.prefetch_missing_metadata()
+        # iterate the live dict; only values are mutated, never the key set
+        for k, v in tqdm(self.metadata.items()):
             for r in v.resources:
                 #if r.type in ('lora', 'embed') and r.filename == '':
                 if r.filename == '':
                     # filename is missing; we need to look it up
                     if r.version_id == '' and r.hash != '':
                         # lookup the version ID with the hash info
+                        # r is the live resource object, so update it directly
                         vid = self.lookup_civitai_id(r.hash)
                         if vid != '':
-                            # update metadata
-                            index = 0
-                            for o in md.resources:
-                                if o.version_id == r.version_id:
-                                    break
-                                index += 1
-                            md.resources[index].version_id = vid
-                            self.metadata.update({k:md})
                             r.version_id = vid
                         else:
                             self.log('Unable to look up version ID for hash ' + r.hash + ' (' + v.orig_filename + ')!', self.log_to_console)
@@ -119,19 +230,10 @@ class Images:
                         # lookup the name with the version ID
                         filename = self.lookup_civitai_filename(r.version_id)
                         if filename != '':
-                            # update metadata
-                            index = 0
-                            for o in md.resources:
-                                if o.version_id == r.version_id:
-                                    break
-                                index += 1
-                            md.resources[index].filename = filename
-
+                            r.filename = filename
                             # also fill in resource and base model names if present
-                            md.resources[index].resource_name = self.lookup_civitai_resource_name(r.version_id)
-                            md.resources[index].base_model = self.lookup_civitai_base_model(r.version_id)
-
-                            self.metadata.update({k:md})
+                            r.resource_name = self.lookup_civitai_resource_name(r.version_id)
+                            r.base_model = self.lookup_civitai_base_model(r.version_id)
                         else:
                             self.log('Unable to look up filename for version ID ' + str(r.version_id) + ' (' + v.orig_filename + ')!', self.log_to_console)
 
@@ -145,7 +247,7 @@ class Images:
             # lookup on civitai
             data = {}
             self.log('Looking up model hash ' + hash + ' on civitai.com...', self.log_to_console)
-            info = requests.get('https://civitai.com/api/v1/model-versions/by-hash/' + str(hash))
+            info = self.session.get('https://civitai.com/api/v1/model-versions/by-hash/' + str(hash))
             try:
                 data = info.json()
             except:
@@ -168,14 +270,12 @@ class Images:
         filename = ''
         if id in self.cache_id:
             # check cache first
-            filename = self.cache_id.get(id)
-            if ',' in filename:
-                filename = filename.split(',', 1)[0]
+            filename = self.cache_id[id][0]
         else:
             # lookup on civitai
             data = {}
             self.log('Looking up model version id ' + str(id) + ' on civitai.com...', self.log_to_console)
-            info = requests.get('https://civitai.com/api/v1/model-versions/' + str(id))
+            info = self.session.get('https://civitai.com/api/v1/model-versions/' + str(id))
             try:
                 data = info.json()
                 if 'files' in data:
@@ -213,51 +313,27 @@ class Images:
     # given a civitai version ID, looks up the resource name
     # this only checks the cache (call this after filename lookups)
     def lookup_civitai_resource_name(self, id):
-        name = ''
         if id in self.cache_id:
-            temp = self.cache_id.get(id)
-            if ',' in temp:
-                data = temp.split(',')
-                if len(data) >= 2:
-                    name = data[1]
-        return name
+            return self.cache_id[id][1]
+        return ''
 
 
     # given a civitai version ID, looks up the base model
     # this only checks the cache (call this after filename lookups)
     def lookup_civitai_base_model(self, id):
-        base = ''
         if id in self.cache_id:
-            temp = self.cache_id.get(id)
-            if ',' in temp:
-                data = temp.split(',')
-                if len(data) >= 3:
-                    base = data[2]
-        return base
+            return self.cache_id[id][2]
+        return ''
 
 
     # given a civitai version ID, looks up the resource type
     # this only checks the cache (call this after filename lookups)
     def lookup_civitai_resource_type(self, id):
-        type = ''
         if id in self.cache_id:
-            temp = self.cache_id.get(id)
-            if ',' in temp:
-                data = temp.split(',')
-                if len(data) >= 4:
-                    type = data[3]
-                    # translate type to match resource names in image metadata
-                    # Semi-complete list? :
-                    # LoCon, LORA, TextualInversion, Checkpoint, DoRA, VAE
-                    if type.lower().strip() in ('lora', 'locon', 'dora'):
-                        type = 'lora'
-                    elif type.lower().strip() in ('textualinversion'):
-                        type = 'embed'
-                    elif type.lower().strip() in ('checkpoint', 'model'):
-                        type = 'model'
-                    elif type.lower().strip() in ('vae'):
-                        type = 'vae'
-        return type
+            type = self.cache_id[id][3]
+            # translate type to match resource names in image metadata
+            return API_TYPE_MAP.get(type.lower().strip(), type)
+        return ''
 
 
     # writes a new civitai.com version ID/filename pair to the cache
@@ -265,46 +341,55 @@ class Images:
         resource_name = resource_name.replace(',', ';')
         base_model = base_model.replace(',', ';')
         type = type.replace(',', ';')
-        if id not in self.cache_id:
-            self.cache_id[id] = filename + ',' + resource_name + ',' + base_model + ',' + type
-            with open(self.cache_id_file, 'a', encoding="utf-8") as f:
-                f.write(str(id) + ',' + filename + ',' + resource_name + ',' + base_model + ',' + type + '\n')
+        with self._cache_lock:
+            if id not in self.cache_id:
+                self.cache_id[id] = (filename, resource_name, base_model, type)
+                self._cache_id_fp.write(str(id) + ',' + filename + ',' + resource_name + ',' + base_model + ',' + type + '\n')
 
     # writes a new civitai.com hash/version ID pair to the cache
     def write_cache_hash(self, hash, id):
-        if hash not in self.cache_hash:
-            self.cache_hash[hash] = id
-            with open(self.cache_hash_file, 'a', encoding="utf-8") as f:
-                f.write(hash + ',' + str(id) + '\n')
+        with self._cache_lock:
+            if hash not in self.cache_hash:
+                self.cache_hash[hash] = id
+                self._cache_hash_fp.write(hash + ',' + str(id) + '\n')
 
     # read previously cached civitai.com version IDs/hash lookups into memory
     def init_caches(self):
+        # iterate the file handles directly (no readlines list) and split
+        # each line exactly once via partition
+        # id cache rows are parsed once into (filename, resource_name,
+        # base_model, type) tuples so lookups just index instead of
+        # re-splitting the raw row on every call
         filepath = self.cache_id_file
         if exists(filepath):
-            with open(filepath, 'r', encoding="utf-8") as f:
-                lines = f.readlines()
-            for line in lines:
-                if ',' in line:
-                    id = line.split(',', 1)[0].strip()
-                    fn = line.split(',', 1)[1].strip()
-                    if id != '' and id != '\n':
-                        self.cache_id[id] = fn
+            with open(filepath, 'r', encoding="utf-8", newline='') as f:
+                for row in csv.reader(f):
+                    if len(row) < 2:
+                        continue
+                    id = row[0].strip()
+                    if id == '':
+                        continue
+                    fields = [x.strip() for x in row[1:5]]
+                    # pad out rows written before the extra detail fields existed
+                    while len(fields) < 4:
+                        fields.append('')
+                    self.cache_id[id] = tuple(fields)
 
         filepath = self.cache_hash_file
         if exists(filepath):
             with open(filepath, 'r', encoding="utf-8") as f:
-                lines = f.readlines()
-            for line in lines:
-                if ',' in line:
-                    id = line.split(',', 1)[0].strip()
-                    fn = line.split(',', 1)[1].strip()
-                    if id != '' and id != '\n':
-                        self.cache_hash[id] = fn
+                for line in f:
+                    id, sep, fn = line.partition(',')
+                    if not sep:
+                        continue
+                    id = id.strip()
+                    if id != '':
+                        self.cache_hash[id] = fn.strip()
 
     # for debugging, prints raw exif tags present in the given image
     def debug_print_metadata_info(self, image_path):
-        image = Image.open(image_path)
-        exif_data = image._getexif()
+        with Image.open(image_path) as image:
+            exif_data = image._getexif()
         if exif_data is not None:
             print('\nEXIF data present in ' + image_path + ':')
             for tag_id in exif_data:
@@ -318,166 +403,138 @@ class Images:
             print('\nNo EXIF data present in ' + image_path + '!')
 
     # for debugging; lists k/v metadata pairs
+    # output is collected in a list and joined once; repeated += on a large
+    # string re-copies the whole buffer every append
     def debug_list_metadata(self):
         self.log("Listing all extracted image metadata...:\n")
         for k, v in self.metadata.items():
-            debug_str = 'Debugging info for ' + k + ':' + '\n'
-            debug_str += 'Original Filename: ' + v.orig_filename + '\n'
-            debug_str += 'Original Filepath: ' + v.orig_filepath + '\n'
-            debug_str += 'Prompt: ' + v.prompt + '\n'
-            debug_str += 'Negative Prompt: ' + v.neg_prompt + '\n'
-            debug_str += 'Seed: ' + str(v.seed) + '\n'
-            debug_str += 'Width: ' + str(v.width) + '\n'
-            debug_str += 'Height: ' + str(v.height) + '\n'
-            debug_str += 'Steps: ' + str(v.steps) + '\n'
-            debug_str += 'Scale: ' + str(v.scale) + '\n'
-            debug_str += 'Strength: ' + str(v.strength) + '\n'
+            parts = ['Debugging info for ' + k + ':']
+            parts.append('Original Filename: ' + v.orig_filename)
+            parts.append('Original Filepath: ' + v.orig_filepath)
+            parts.append('Prompt: ' + v.prompt)
+            parts.append('Negative Prompt: ' + v.neg_prompt)
+            parts.append('Seed: ' + str(v.seed))
+            parts.append('Width: ' + str(v.width))
+            parts.append('Height: ' + str(v.height))
+            parts.append('Steps: ' + str(v.steps))
+            parts.append('Scale: ' + str(v.scale))
+            parts.append('Strength: ' + str(v.strength))
             if v.base_model != '':
-                debug_str += 'Model: ' + v.model + ' (base: ' + v.base_model + ')\n'
+                parts.append('Model: ' + v.model + ' (base: ' + v.base_model + ')')
             else:
-                debug_str += 'Model: ' + v.model + ' (unknown base model)\n'
-            debug_str += 'Model Hash: ' + str(v.hash) + '\n'
-            debug_str += 'Sampler: ' + v.sampler + '\n'
-            debug_str += 'Clip Skip: ' + str(v.clip_skip) + '\n'
-            debug_str += 'Resources: ' + self.debug_list_resources(v.resources)
-            debug_str += 'Raw Metadata: ' + v.raw_metadata + '\n'
-            self.log(debug_str)
+                parts.append('Model: ' + v.model + ' (unknown base model)')
+            parts.append('Model Hash: ' + str(v.hash))
+            parts.append('Sampler: ' + v.sampler)
+            parts.append('Clip Skip: ' + str(v.clip_skip))
+            parts.append('Resources: ' + self.debug_list_resources(v.resources).rstrip('\n'))
+            parts.append('Raw Metadata: ' + v.raw_metadata)
+            self.log('\n'.join(parts) + '\n')
 
     # for debugging; resources used in an image
     def debug_list_resources(self, res):
-        resources = ''
+        parts = []
         count = 0
         for r in res:
             count += 1
-            resources += ' [' + str(count) + '] (' + r.type + ')\n'
-            resources += '   Resource Name: ' + r.resource_name + '\n'
-            resources += '   Version ID: ' + str(r.version_id) + '\n'
-            resources += '   Hash: ' + r.hash + '\n'
-            resources += '   Filename: ' + r.filename + '\n'
-            resources += '   Base Model: ' + r.base_model + '\n'
+            parts.append(' [' + str(count) + '] (' + r.type + ')')
+            parts.append('   Resource Name: ' + r.resource_name)
+            parts.append('   Version ID: ' + str(r.version_id))
+            parts.append('   Hash: ' + r.hash)
+            parts.append('   Filename: ' + r.filename)
+            parts.append('   Base Model: ' + r.base_model)
             if r.type == 'lora':
-                resources += '   LoRA Weight: ' + str(r.weight) + '\n'
-        if resources == '':
-            resources = 'none\n'
-        else:
-            resources = str(count) + ' total resources used:\n' + resources
-        return resources
+                parts.append('   LoRA Weight: ' + str(r.weight))
+        if not parts:
+            return 'none\n'
+        return str(count) + ' total resources used:\n' + '\n'.join(parts) + '\n'
 
 
     # for debugging; lists the different types of resources found in metadata
     # types here are what the image metadata claims it is
     def debug_list_metadata_resource_types(self):
-        output = "These types of resources were found in image metadata:\n"
+        parts = ["These types of resources were found in image metadata:"]
         types = set()
         for k, v in self.metadata.items():
             for r in v.resources:
                 types.add(r.type)
         for t in types:
-            output += ' ' + t + '\n'
-        self.log(output)
+            parts.append(' ' + t)
+        self.log('\n'.join(parts) + '\n')
 
 
     # for debugging; lists the different types of resources found in metadata
     # types here are after looking up the version IDs of resources via API
     def debug_list_metadata_resource_types_via_api(self):
-        output = "These types of resources were found in image metadata (API verified):\n"
+        parts = ["These types of resources were found in image metadata (API verified):"]
         types = set()
         for k, v in self.metadata.items():
             for r in v.resources:
                 api_type = self.lookup_civitai_resource_type(r.version_id)
                 types.add(api_type)
         for t in types:
-            output += ' ' + t + '\n'
-        self.log(output)
+            parts.append(' ' + t)
+        self.log('\n'.join(parts) + '\n')
 
 
     # for debugging; lists the different base models used in the images
     def debug_list_base_model_breakdown(self):
-        output = "Base model breakdown by image count:\n"
-        bases = set()
-        counts = []
-        d = {}
-        for k, v in self.metadata.items():
-            bases.add(v.base_model)
-            counts.append(v.base_model)
-        for base in bases:
-            base = base.strip()
-            if base == '':
-                base = 'Unknown'
-            count = counts.count(base)
-            if count > 0:
-                d[base] = count
+        parts = ["Base model breakdown by image count:"]
+        d = Counter((v.base_model.strip() or 'Unknown') for v in self.metadata.values())
         final = sorted(d.items(), key=lambda x: x[1], reverse=True)
         for k, v in final:
-            output += '  ' + k + ': ' + str(v) + '\n'
-        self.log(output, self.log_to_console)
+            parts.append('  ' + k + ': ' + str(v))
+        self.log('\n'.join(parts) + '\n', self.log_to_console)
 
 
     # for debugging; lists the different main models used in the images
     def debug_list_model_breakdown(self, show_base=True):
-        output = "Model breakdown by image count:\n"
-        models = set()
+        parts = ["Model breakdown by image count:"]
         counts = []
-        d = {}
+        # resolve each unique hash once; many images share a few checkpoints
+        hash_to_name = {}
         for k, v in self.metadata.items():
             m = v.model
             if v.hash != '':
-                vid = self.lookup_civitai_id(v.hash)
-                if vid != '':
-                    filename = self.lookup_civitai_filename(vid)
-                    if filename != '':
-                        m = filename
+                if v.hash not in hash_to_name:
+                    name = ''
+                    vid = self.lookup_civitai_id(v.hash)
+                    if vid != '':
+                        name = self.lookup_civitai_filename(vid)
+                    hash_to_name[v.hash] = name
+                if hash_to_name[v.hash] != '':
+                    m = hash_to_name[v.hash]
             if m.endswith('.safetensors'):
                 m = m[:-12]
             if show_base and v.base_model != '':
                 m = m + ' (' + v.base_model + ')'
-            models.add(m)
-            counts.append(m)
-        for model in models:
-            model = model.strip()
-            if model == '':
-                model = 'Unknown'
-            count = counts.count(model)
-            if count > 0:
-                d[model] = count
+            counts.append(m.strip() or 'Unknown')
+        d = Counter(counts)
         final = sorted(d.items(), key=lambda x: x[1], reverse=True)
         for k, v in final:
-            output += '  ' + k + ': ' + str(v) + '\n'
-        self.log(output, self.log_to_console)
+            parts.append('  ' + k + ': ' + str(v))
+        self.log('\n'.join(parts) + '\n', self.log_to_console)
 
 
     # for debugging; lists the different samplers used in the images
     def debug_list_sampler_breakdown(self):
-        output = "Sampler breakdown by image count:\n"
-        samplers = set()
-        counts = []
-        d = {}
-        for k, v in self.metadata.items():
-            s = v.sampler
-            samplers.add(s)
-            counts.append(s)
-        for sampler in samplers:
-            sampler = sampler.strip()
-            if sampler == '':
-                sampler = 'Unknown'
-            count = counts.count(sampler)
-            if count > 0:
-                d[sampler] = count
+        parts = ["Sampler breakdown by image count:"]
+        d = Counter((v.sampler.strip() or 'Unknown') for v in self.metadata.values())
         final = sorted(d.items(), key=lambda x: x[1], reverse=True)
         for k, v in final:
-            output += '  ' + k + ': ' + str(v) + '\n'
-        self.log(output, self.log_to_console)
-        return samplers
+            parts.append('  ' + k + ': ' + str(v))
+        self.log('\n'.join(parts) + '\n', self.log_to_console)
+        return set(d)
 
 
     # looks at all metadata and attempts to infer what base model was used for this image
     def infer_base_models(self):
         self.log("Attempting to infer base models for all images...")
-        for k, v in tqdm(self.metadata.copy().items()):
-            md = v
-            base = ''
-
-            if v.hash != '':
+        # resolve each unique main model hash once; many images typically
+        # share a small set of checkpoints
+        hash2base = {}
+        for v in self.metadata.values():
+            if v.hash != '' and v.hash not in hash2base:
+                base = ''
                 # see if we have a cache entry for the main model hash
                 vid = self.lookup_civitai_id(v.hash)
                 if vid != '':
@@ -487,6 +544,12 @@ class Images:
                     if filename != '':
                         # if the above succeeded, this should return the proper base
                         base = self.lookup_civitai_base_model(vid)
+                hash2base[v.hash] = base
+
+        # iterate the live dict; only values are mutated, never the key set
+        for k, v in tqdm(self.metadata.items()):
+            md = v
+            base = hash2base.get(v.hash, '')
 
             if base == '':
                 # if we're not able to lookup directly via hash, we'll need to
@@ -512,16 +575,21 @@ class Images:
                     base = 'Pony'
 
             if base != '':
-                md.base_model = base
+                # base model names are drawn from a small fixed set; intern
+                # so every image shares the same str object per base
+                md.base_model = sys.intern(base)
                 self.metadata.update({k:md})
 
     # decodes relevent metadata present in all images
     def extract_metadata_from_images(self):
         if len(self.images) > 0:
             self.log('Looking for metadata in images...')
-            for img in tqdm(self.images):
-                self.log('Working on ' + img + '...', self.log_to_console)
-                data = self.read_exif(img)
+            # EXIF extraction is I/O-bound (PIL releases the GIL inside
+            # libjpeg/libpng), so read the images over a thread pool; the
+            # metadata dict itself is only updated from this thread
+            with ThreadPoolExecutor(max_workers = (os.cpu_count() or 1) * 2) as executor:
+                results = list(tqdm(executor.map(self.read_exif, self.images), total = len(self.images)))
+            for img, data in zip(self.images, results):
                 if data == '':
                     self.log(img + ' contains no metadata!', self.log_to_console)
                     pass
@@ -539,35 +607,34 @@ class Images:
         if not exists(image_path):
             self.log('Error: ' + image_path + ' does not appear to exist (possible filename too long?)!')
             return ''
-        image = Image.open(image_path)
-        exif_data = image._getexif()
-        if exif_data is not None:
-            # check for Dream Factory metadata first
-            try:
-                data = exif_data[0x9c9c].decode('utf16')
-            except KeyError as e:
-                pass
-            else:
-                return data
-            # check for others
-            for tag_id in exif_data:
-                tag = TAGS.get(tag_id, tag_id)
-                data = exif_data.get(tag_id)
-                if isinstance(data, bytes):
-                    data = data.decode(errors='replace')
-                if tag == 'UserComment':
+        # PNGs carry their metadata in text chunks (populated on open), so
+        # go straight there instead of paying for the EXIF decode path
+        if image_path.lower().endswith('.png'):
+            with Image.open(image_path) as image:
+                return image.info.get('parameters') or getattr(image, 'text', {}).get('prompt', '')
+        # use a context manager so the file handle is released per image
+        with Image.open(image_path) as image:
+            exif_data = image._getexif()
+            if exif_data is not None:
+                # check for Dream Factory metadata first
+                try:
+                    data = exif_data[0x9c9c].decode('utf16')
+                except KeyError as e:
+                    pass
+                else:
+                    return data
+                # check for UserComment via its fixed tag id (0x9286) instead
+                # of scanning every tag through the TAGS name table
+                data = exif_data.get(0x9286)
+                if data is not None:
+                    if isinstance(data, bytes):
+                        data = data.decode(errors='replace')
                     if data.startswith('UNICODE'):
                         data = data.replace('UNICODE', '', 1)
                     return data.replace('\x00', '')
-        else:
-            # try to extract comfy workflow
-            prompt = ''
-            try:
-                metadata = image.text
-                prompt = metadata["prompt"]
-            except:
-                prompt = ''
-            return prompt
+            else:
+                # try to extract comfy workflow
+                return getattr(image, 'text', {}).get('prompt', '')
         return ''
 
     # collect all image files in the specified target location
@@ -586,442 +653,440 @@ class Images:
     def get_images_from_dir(self, dir):
         images = []
         for f in os.scandir(dir):
-            if f.path.lower().endswith('.jpg') or f.path.lower().endswith('.jpeg') or f.path.lower().endswith('.png'):
+            if f.name.lower().endswith(('.jpg', '.jpeg', '.png')):
                 images.append(f.path)
         images.sort()
         return images
 
     # gets images found within specified dir and all sub-dirs
+    # explicit os.scandir stack instead of os.walk; the dirent info from
+    # readdir is re-used so we avoid an extra stat call per entry
     def get_images_from_tree(self, root_dir):
         images = []
-        for root, dirs, files in os.walk(root_dir, topdown=False):
-            for name in files:
-                if name.lower().endswith('.jpg') or name.lower().endswith('.jpeg') or name.lower().endswith('.png'):
-                    full_file_path = os.path.join(root, name)
-                    images.append(full_file_path)
-
-            for name in dirs:
-                full_dir_path = os.path.join(root, name)
+        # missing/mistyped paths should yield no images, matching os.walk
+        if not root_dir or not os.path.isdir(root_dir):
+            return images
+        stack = [root_dir]
+        while stack:
+            dir = stack.pop()
+            # skip unreadable/vanished subdirs like os.walk did
+            try:
+                it = os.scandir(dir)
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks = False):
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                        images.append(entry.path)
         images.sort()
         return images
 
+    # flushes the cache/log files and closes the shared API session
+    def close(self):
+        if not self._cache_id_fp.closed:
+            self._cache_id_fp.close()
+        if not self._cache_hash_fp.closed:
+            self._cache_hash_fp.close()
+        if not self._logf.closed:
+            self._logf.close()
+        self.session.close()
+
+    def __del__(self):
+        self.close()
+
     # handles logging to file/console
     def log(self, line, console = True):
         output = '[Images] > ' + str(line)
         if console:
             print(output)
-        with open(self.logfile, 'a', encoding="utf-8") as f:
-            f.write(output + '\n')
+        self._logf.write(output + '\n')
+        if console:
+            self._logf.flush()
 
     # extracts SD parameters from the full command
+    # the per-image parse is CPU-bound pure-Python string work with no
+    # shared state, so large catalogs are spread across worker processes
+    # to bypass the GIL; small catalogs aren't worth the process spin-up
     def decode_metadata(self):
-        for key, val in self.metadata.copy().items():
-            self.log('Decoding metadata for ' + val.orig_filename + '...', False)
-            md = val
-            command = md.raw_metadata
-            if command != "":
-                dream_factory = False
-                is_json = True
+        items = list(self.metadata.items())
+        if len(items) >= 256 and (os.cpu_count() or 1) > 1:
+            with ProcessPoolExecutor(max_workers = os.cpu_count()) as executor:
+                self.commit_decoded(executor.map(decode_single_metadata, items, chunksize = 64))
+        else:
+            self.commit_decoded(map(decode_single_metadata, items))
+
+    # stores decoded metadata and writes any deferred worker log lines
+    # (metadata updates stay on this thread/process)
+    def commit_decoded(self, results):
+        for key, md, logs in results:
+            self.log('Decoding metadata for ' + md.orig_filename + '...', False)
+            for line in logs:
+                self.log(line, self.log_to_console)
+            self.metadata[key] = md
+
+
+# legacy substring scraping of the 'Civitai resources:' block; only used
+# when the block isn't a well-formed JSON array (e.g. the 'Type = lora }"'
+# variant) and the single-pass json.loads path can't handle it
+def decode_civitai_resources_legacy(p, md, logs):
+    # get loras
+    resources = p.split('Civitai resources:', 1)[1].strip()
+    while '{"type":"lora",' in resources and '}' in resources:
+        work = resources.split('{"type":"lora",', 1)[1].split('}', 1)[0]
+        if '"modelVersionId":' in work and ',' in work:
+            id = work.split('"modelVersionId":', 1)[1].split(',', 1)[0]
+            weight = 1.0
+            if '"weight":' in work and ',' in work:
+                w = work.split('"weight":', 1)[1].split(',', 1)[0]
                 try:
-                    json.loads(command)
+                    weight = float(w)
                 except:
-                    is_json = False
-                p = ''
-
-                if is_json:
-                    errors = 0
-                    workflow = json.loads(command)
-                    software = ''
-                    is_comfy = True
-                    if 'Fooocus v' in command:
-                        software = 'Fooocus'
-                        is_comfy = False
-                        try:
-                            md.prompt = utils.sanitize_prompt(workflow['prompt'])
-                            md.neg_prompt = utils.sanitize_prompt(workflow['negative_prompt'])
-                            md.steps = workflow['steps']
-                            md.scale = workflow['guidance_scale']
-                            res = workflow['resolution'].strip('(').strip(')')
-                            md.width = res.split(',', 1)[0].strip()
-                            md.height = res.split(',', 1)[1].strip()
-                            md.sampler = workflow['sampler']
-                            md.scheduler = workflow['scheduler']
-                            md.seed = workflow['seed']
-                            md.model = utils.extract_model_filename(workflow['base_model'])
-                            md.hash = workflow['base_model_hash']
-                        except:
-                            errors += 1
-                        else:
-                            # if above succeeded, try to get loras as well
-                            try:
-                                loras = workflow['loras']
-                                for lora in loras:
-                                    rsc = ImageResources()
-                                    rsc.type = 'lora'
-                                    rsc.hash = lora[2]
-                                    rsc.weight = lora[1]
-                                    md.resources.append(rsc)
-                            except:
-                                pass
-
-                    elif 'RuinedFooocus' in command:
-                        # RuinedFooocus does not include LoRA hashes or civitai IDs so
-                        # cannot look them up
-                        software = 'RuinedFooocus'
-                        is_comfy = False
-                        try:
-                            md.prompt = utils.sanitize_prompt(workflow['Prompt'])
-                            md.neg_prompt = utils.sanitize_prompt(workflow['Negative'])
-                            md.steps = workflow['steps']
-                            md.scale = workflow['cfg']
-                            md.width = workflow['width']
-                            md.height = workflow['height']
-                            md.sampler = workflow['sampler_name']
-                            md.scheduler = workflow['scheduler']
-                            md.seed = workflow['seed']
-                            md.model = utils.extract_model_filename(workflow['base_model_name'])
-                            md.hash = workflow['base_model_hash']
-                        except:
-                            errors += 1
-
-                    if is_comfy:
-                        # created by ComfyUI
-                        # will not be 100% accurate for complex workflows with multiple prompts
-                        software = 'ComfyUI'
-                        for node in workflow:
-                            data = workflow[node]
-                            try:
-                                if 'inputs' in data and 'text_positive' in data['inputs']:
-                                    if isinstance(data['inputs']['text_positive'], str):
-                                        md.prompt = utils.sanitize_prompt(data['inputs']['text_positive'].strip())
-                                if 'inputs' in data and 'text_negative' in data['inputs']:
-                                    if isinstance(data['inputs']['text_negative'], str):
-                                        md.neg_prompt = utils.sanitize_prompt(data['inputs']['text_negative'].strip())
-                                if 'inputs' in data and 'noise_seed' in data['inputs']:
-                                    try:
-                                        int(data['inputs']['noise_seed'])
-                                    except:
-                                        pass
-                                    else:
-                                        md.seed = data['inputs']['noise_seed']
-                                if 'inputs' in data and 'sampler_name' in data['inputs']:
-                                    if isinstance(data['inputs']['sampler_name'], str):
-                                        md.sampler = data['inputs']['sampler_name']
-                                if 'inputs' in data and 'scheduler' in data['inputs']:
-                                    if isinstance(data['inputs']['scheduler'], str):
-                                        md.scheduler = data['inputs']['scheduler']
-                                    if 'steps' in data['inputs']:
-                                        if isinstance(data['inputs']['steps'], int):
-                                            md.steps = data['inputs']['steps']
-                                if 'inputs' in data and 'guidance' in data['inputs']:
-                                    if isinstance(data['inputs']['guidance'], float):
-                                        md.scale = data['inputs']['guidance']
-                                if 'inputs' in data and 'unet_name' in data['inputs']:
-                                    if isinstance(data['inputs']['unet_name'], str):
-                                        md.model = utils.extract_model_filename(data['inputs']['unet_name'])
-                                if 'inputs' in data and 'width' in data['inputs']:
-                                    try:
-                                        int(data['inputs']['width'])
-                                    except:
-                                        pass
-                                    else:
-                                        md.width = data['inputs']['width']
-                                if 'inputs' in data and 'height' in data['inputs']:
-                                    try:
-                                        int(data['inputs']['height'])
-                                    except:
-                                        pass
-                                    else:
-                                        md.height = data['inputs']['height']
-                                if 'inputs' in data and 'resolution' in data['inputs']:
-                                    if isinstance(data['inputs']['resolution'], str):
-                                        if 'x' in data['inputs']['resolution'].lower():
-                                            md.width = data['inputs']['resolution'].lower().strip().split('x', 1)[0]
-                                            md.height = data['inputs']['resolution'].lower().strip().split('x', 1)[1]
-                                            if ' ' in md.height:
-                                                md.height = md.height.split(' ', 1)[0]
-                            except:
-                                errors += 1
-                        # second pass to look for prompt in other nodes if necessary
-                        if md.prompt == '':
-                            for node in workflow:
-                                data = workflow[node]
-                                try:
-                                    old_prompt = md.prompt
-                                    if 'inputs' in data:
-                                        if 'text' in data['inputs']:
-                                            if isinstance(data['inputs']['text'], str):
-                                                new_prompt = utils.sanitize_prompt(data['inputs']['text'].strip())
-                                                # if there are multiple prompts in the workflow, take the longest
-                                                if len(new_prompt) > len(old_prompt):
-                                                    md.prompt = new_prompt
-                                        elif 'wildcard_text' in data['inputs']:
-                                            if isinstance(data['inputs']['wildcard_text'], str):
-                                                new_prompt = utils.sanitize_prompt(data['inputs']['wildcard_text'].strip())
-                                                # if there are multiple prompts in the workflow, take the longest
-                                                if len(new_prompt) > len(old_prompt):
-                                                    md.prompt = new_prompt
-                                except:
-                                    errors += 1
+                    weight = 1.0
+            rsc = ImageResources()
+            rsc.type = 'lora'
+            rsc.version_id = id
+            rsc.weight = weight
+            md.resources.append(rsc)
+        before = resources.split('{"type":"lora",', 1)[0]
+        after = resources.split('{"type":"lora",', 1)[1].split('}', 1)[1]
+        resources = (before + after).strip()
+
+    # get checkpoints
+    resources = p.split('Civitai resources:', 1)[1].strip()
+    while '{"type":"checkpoint",' in resources and '}' in resources:
+        work = resources.split('{"type":"checkpoint",', 1)[1].split('}', 1)[0]
+        id = ''
+        if '"modelVersionId":' in work and ',' in work:
+            id = work.split('"modelVersionId":', 1)[1].split(',', 1)[0]
+        elif '"modelVersionId":' in work:
+            id = work.split('"modelVersionId":', 1)[1].strip()
+        if id != '':
+            rsc = ImageResources()
+            rsc.type = 'checkpoint'
+            rsc.version_id = id
+            md.resources.append(rsc)
+        before = resources.split('{"type":"checkpoint",', 1)[0]
+        after = resources.split('{"type":"checkpoint",', 1)[1].split('}', 1)[1]
+        resources = (before + after).strip()
+
+    # get embeddings
+    resources = p.split('Civitai resources:', 1)[1].strip()
+    while '{"type":"embed",' in resources and '}' in resources:
+        work = resources.split('{"type":"embed",', 1)[1].split('}', 1)[0]
+        if '"modelVersionId":' in work and ',' in work:
+            id = work.split('"modelVersionId":', 1)[1].split(',', 1)[0]
+            rsc = ImageResources()
+            rsc.type = 'embed'
+            rsc.version_id = id
+            md.resources.append(rsc)
+        before = resources.split('{"type":"embed",', 1)[0]
+        after = resources.split('{"type":"embed",', 1)[1].split('}', 1)[1]
+        resources = (before + after).strip()
+
+    # extra pass to get loras in different format
+    resources = p.split('Civitai resources:', 1)[1].strip()
+    while 'Type = lora }"' in resources and '}' in resources:
+        work = resources.split('Type = lora }"', 1)[1].split('}', 1)[0]
+        if '"modelVersionId":' in work:
+            id = work.split('"modelVersionId":', 1)[1]
+            found = is_intable(id)
+            if not found:
+                logs.append('Unable to determine lora ID from metadata in ' + md.orig_filename)
+            if found:
+                weight = 1.0
+                if '"weight":' in work and ',' in work:
+                    w = work.split('"weight":', 1)[1].split(',', 1)[0]
+                    try:
+                        weight = float(w)
+                    except:
+                        weight = 1.0
+                rsc = ImageResources()
+                rsc.type = 'lora'
+                rsc.version_id = id
+                rsc.weight = weight
+                md.resources.append(rsc)
+        before = resources.split('Type = lora }"', 1)[0]
+        after = resources.split('Type = lora }"', 1)[1].split('}', 1)[1]
+        resources = (before + after).strip()
+
+# decodes one image's raw metadata into its ImageMetaData object
+# module-level (and self-free) so it can be dispatched to worker
+# processes; returns (key, md, logs) where logs holds deferred log
+# lines for the parent process to write
+def decode_single_metadata(item):
+    key, md = item
+    logs = []
+    command = md.raw_metadata
+    if command != "":
+        dream_factory = False
+        # parse once; the parsed workflow is re-used below instead of
+        # round-tripping json.loads a second time
+        try:
+            workflow = json_loads(command)
+        except:
+            workflow = None
+        is_json = isinstance(workflow, dict)
+        p = ''
+
+        if is_json:
+            errors = 0
+            software = ''
+            is_comfy = True
+            if 'Fooocus v' in str(workflow.get('version', '')):
+                software = 'Fooocus'
+                is_comfy = False
+                try:
+                    md.prompt = utils.sanitize_prompt(workflow['prompt'])
+                    md.neg_prompt = utils.sanitize_prompt(workflow['negative_prompt'])
+                    md.steps = workflow['steps']
+                    md.scale = workflow['guidance_scale']
+                    res = workflow['resolution'].strip('(').strip(')')
+                    w, sep, h = res.partition(',')
+                    md.width = w.strip()
+                    md.height = h.strip()
+                    md.sampler = workflow['sampler']
+                    md.scheduler = workflow['scheduler']
+                    md.seed = workflow['seed']
+                    md.model = extract_model_filename(workflow['base_model'])
+                    md.hash = workflow['base_model_hash']
+                except:
+                    errors += 1
+                else:
+                    # if above succeeded, try to get loras as well
+                    try:
+                        loras = workflow['loras']
+                        for lora in loras:
+                            rsc = ImageResources()
+                            rsc.type = 'lora'
+                            rsc.hash = lora[2]
+                            rsc.weight = lora[1]
+                            md.resources.append(rsc)
+                    except:
+                        pass
 
-                    else:
-                        if software == '':
-                            self.log('Unsupported JSON metadata format encountered: ' + val.orig_filename + '!', False)
-                        else:
-                            self.log('Unsupported JSON metadata format encountered (' + software + '): ' + val.orig_filename + '!', False)
+            elif 'RuinedFooocus' in str(workflow.get('software', '')):
+                # RuinedFooocus does not include LoRA hashes or civitai IDs so
+                # cannot look them up
+                software = 'RuinedFooocus'
+                is_comfy = False
+                try:
+                    md.prompt = utils.sanitize_prompt(workflow['Prompt'])
+                    md.neg_prompt = utils.sanitize_prompt(workflow['Negative'])
+                    md.steps = workflow['steps']
+                    md.scale = workflow['cfg']
+                    md.width = workflow['width']
+                    md.height = workflow['height']
+                    md.sampler = workflow['sampler_name']
+                    md.scheduler = workflow['scheduler']
+                    md.seed = workflow['seed']
+                    md.model = extract_model_filename(workflow['base_model_name'])
+                    md.hash = workflow['base_model_hash']
+                except:
+                    errors += 1
+
+            if is_comfy:
+                # created by ComfyUI
+                # will not be 100% accurate for complex workflows with multiple prompts
+                software = 'ComfyUI'
+                # nodes without an inputs dict (bare loaders etc.) are
+                # filtered structurally, so no try/except is needed; the
+                # field handlers type-check everything they touch
+                for node, data in workflow.items():
+                    inp = data.get('inputs') if isinstance(data, dict) else None
+                    if not isinstance(inp, dict):
+                        continue
+                    for input_key, attr, fn in COMFY_FIELDS:
+                        if input_key in inp:
+                            value = fn(inp[input_key])
+                            if value is not None:
+                                setattr(md, attr, value)
+                    if 'resolution' in inp and isinstance(inp['resolution'], str):
+                        res = inp['resolution'].lower().strip()
+                        w, sep, h = res.partition('x')
+                        if sep:
+                            md.width = w
+                            md.height = h.split(' ', 1)[0] if ' ' in h else h
+                # second pass to look for prompt in other nodes if necessary
+                if md.prompt == '':
+                    for node, data in workflow.items():
+                        inp = data.get('inputs') if isinstance(data, dict) else None
+                        if not isinstance(inp, dict):
+                            continue
+                        new_prompt = ''
+                        if isinstance(inp.get('text'), str):
+                            new_prompt = utils.sanitize_prompt(inp['text'].strip())
+                        elif isinstance(inp.get('wildcard_text'), str):
+                            new_prompt = utils.sanitize_prompt(inp['wildcard_text'].strip())
+                        # if there are multiple prompts in the workflow, take the longest
+                        if len(new_prompt) > len(md.prompt):
+                            md.prompt = new_prompt
 
-                    if errors > 0:
-                        self.log('Error reading JSON metadata from ' + val.orig_filename + '!', False)
+            else:
+                if software == '':
+                    logs.append('Unsupported JSON metadata format encountered: ' + md.orig_filename + '!')
+                else:
+                    logs.append('Unsupported JSON metadata format encountered (' + software + '): ' + md.orig_filename + '!')
 
+            if errors > 0:
+                logs.append('Error reading JSON metadata from ' + md.orig_filename + '!')
+
+        else:
+            # not JSON
+            command = command.strip('"')
+            if '--neg_prompt' in command:
+                # this was created by Dream Factory
+                dream_factory = True
+                df_params = utils.extract_params_from_command(command)
+                md.prompt = utils.sanitize_prompt(df_params.get('prompt')).strip().strip('"')
+                md.neg_prompt = utils.sanitize_prompt(df_params.get('neg_prompt')).strip().strip('"')
+                md.steps = df_params.get('steps')
+                md.scale = df_params.get('scale')
+                md.strength = df_params.get('strength')
+                md.width = df_params.get('width')
+                md.height = df_params.get('height')
+                md.sampler = df_params.get('sampler')
+                md.seed = df_params.get('seed')
+                md.clip_skip = df_params.get('clip_skip')
+                md.model = extract_model_filename(df_params.get('model'))
+                md.hash = extract_model_hash(df_params.get('model'))
+
+            elif 'Negative prompt:' in command:
+                # partition once instead of re-splitting the command
+                # for the prompt, the negative, and the param tail
+                before, sep, after = command.partition('Negative prompt:')
+                # we'll assume anything before this is the prompt
+                temp = before.strip()
+                temp = temp.replace('\\', '')
+                md.prompt = utils.sanitize_prompt(temp)
+
+                # get negative
+                p = after.strip()
+                temp = p
+                if temp.startswith('Steps:'):
+                    temp = ''
+                elif '\nSteps:' in temp:
+                    temp = temp.split('\nSteps:', 1)[0]
+                elif '\n' in temp:
+                    temp = temp.split('\n', 1)[0]
+
+                md.neg_prompt = utils.sanitize_prompt(temp).strip().strip('"')
+            else:
+                before, sep, after = command.rpartition('\n')
+                if sep:
+                    md.prompt = utils.sanitize_prompt(before.strip())
+                    p = after
                 else:
-                    # not JSON
-                    command = command.strip('"')
-                    if '--neg_prompt' in command:
-                        # this was created by Dream Factory
-                        dream_factory = True
-                        df_params = utils.extract_params_from_command(command)
-                        md.prompt = utils.sanitize_prompt(df_params.get('prompt')).strip().strip('"')
-                        md.neg_prompt = utils.sanitize_prompt(df_params.get('neg_prompt')).strip().strip('"')
-                        md.steps = df_params.get('steps')
-                        md.scale = df_params.get('scale')
-                        md.strength = df_params.get('strength')
-                        md.width = df_params.get('width')
-                        md.height = df_params.get('height')
-                        md.sampler = df_params.get('sampler')
-                        md.seed = df_params.get('seed')
-                        md.clip_skip = df_params.get('clip_skip')
-                        md.model = utils.extract_model_filename(df_params.get('model'))
-                        md.hash = utils.extract_model_hash(df_params.get('model'))
-
-                    elif 'Negative prompt:' in command:
-                        # we'll assume anything before this is the prompt
-                        temp = command.split('Negative prompt:', 1)[0]
-                        temp = temp.strip()
-                        temp = temp.replace('\\', '')
-                        md.prompt = utils.sanitize_prompt(temp)
-
-                        # get negative
-                        temp = command.split('Negative prompt:', 1)[1].strip()
-                        if temp.startswith('Steps:'):
-                            temp = ''
-                        elif '\nSteps:' in temp:
-                            temp = temp.split('\nSteps:', 1)[0]
-                        elif '\n' in temp:
-                            temp = temp.split('\n', 1)[0]
-
-                        md.neg_prompt = utils.sanitize_prompt(temp).strip().strip('"')
-                        p = command.split('Negative prompt:', 1)[1].strip()
-                    else:
-                        if '\n' in command:
-                            temp = command.rsplit('\n', 1)[0].strip()
-                            md.prompt = utils.sanitize_prompt(temp)
-                            p = command.rsplit('\n', 1)[1]
-                        else:
-                            p = command
-
-                    # get the rest of the params:
-                    if not dream_factory:
-                        if 'Steps:' in p and ',' in p:
-                            v = p.split('Steps:', 1)[1].strip()
-                            v = v.split(',', 1)[0].strip()
-                            md.steps = v
-
-                        # TODO case-insensitive match/replace here
-                        if 'CFG scale:' in p and ',' in p:
-                            v = p.split('CFG scale:', 1)[1].strip()
-                            v = v.split(',', 1)[0].strip()
-                            md.scale = v
-                        elif 'CFG Scale:' in p and ',' in p:
-                            v = p.split('CFG Scale:', 1)[1].strip()
-                            v = v.split(',', 1)[0].strip()
-                            md.scale = v
-
-                        if 'Denoising strength:' in p and ',' in p:
-                            v = p.split('Denoising strength:', 1)[1].strip()
-                            v = v.split(',', 1)[0].strip()
-                            md.strength = v
-
-                        if 'Size:' in p and ',' in p:
-                            v = p.split('Size:', 1)[1].strip()
-                            v = v.split(',', 1)[0].strip()
-                            if 'x' in v:
-                                width = v.split('x', 1)[0].strip()
-                                height = v.split('x', 1)[1].strip()
-                                md.width = width
-                                md.height = height
-
-                        if 'Clip skip:' in p and ',' in p:
-                            v = p.split('Clip skip:', 1)[1].strip()
-                            v = v.split(',', 1)[0].strip()
-                            md.clip_skip = v
-
-                        if 'Sampler:' in p and ',' in p:
-                            v = p.split('Sampler:', 1)[1].strip()
-                            v = v.split(',', 1)[0].strip()
-                            if v.endswith(' Exponential'):
-                                v = v.replace(' Exponential', '')
-                            if v.endswith(' Karras'):
-                                v = v.replace(' Karras', '')
-                            md.sampler = v
-
-                        if 'Seed:' in p and ',' in p:
-                            v = p.split('Seed:', 1)[1].strip()
-                            v = v.split(',', 1)[0].strip()
-                            md.seed = v
-
-                        if 'Model:' in p and ',' in p:
-                            v = p.split('Model:', 1)[1].strip()
-                            v = v.split(',', 1)[0].strip()
-                            md.model = utils.extract_model_filename(v)
-
-                        if 'Model hash:' in p and ',' in p:
-                            v = p.split('Model hash:', 1)[1].strip()
-                            v = v.split(',', 1)[0].strip()
-                            md.hash = v
-
-                    # get resources used:
-                    if 'Civitai resources:' in p:
-                        # option 1
-                        # get loras
-                        resources = p.split('Civitai resources:', 1)[1].strip()
-                        while '{"type":"lora",' in resources and '}' in resources:
-                            work = resources.split('{"type":"lora",', 1)[1].split('}', 1)[0]
-                            if '"modelVersionId":' in work and ',' in work:
-                                id = work.split('"modelVersionId":', 1)[1].split(',', 1)[0]
-                                weight = 1.0
-                                if '"weight":' in work and ',' in work:
-                                    w = work.split('"weight":', 1)[1].split(',', 1)[0]
-                                    try:
-                                        weight = float(w)
-                                    except:
-                                        weight = 1.0
-                                rsc = ImageResources()
-                                rsc.type = 'lora'
-                                rsc.version_id = id
-                                rsc.weight = weight
-                                md.resources.append(rsc)
-                            before = resources.split('{"type":"lora",', 1)[0]
-                            after = resources.split('{"type":"lora",', 1)[1].split('}', 1)[1]
-                            resources = (before + after).strip()
-
-                        # get checkpoints
-                        resources = p.split('Civitai resources:', 1)[1].strip()
-                        while '{"type":"checkpoint",' in resources and '}' in resources:
-                            work = resources.split('{"type":"checkpoint",', 1)[1].split('}', 1)[0]
-                            id = ''
-                            if '"modelVersionId":' in work and ',' in work:
-                                id = work.split('"modelVersionId":', 1)[1].split(',', 1)[0]
-                            elif '"modelVersionId":' in work:
-                                id = work.split('"modelVersionId":', 1)[1].strip()
-                            if id != '':
-                                rsc = ImageResources()
-                                rsc.type = 'checkpoint'
-                                rsc.version_id = id
-                                md.resources.append(rsc)
-                            before = resources.split('{"type":"checkpoint",', 1)[0]
-                            after = resources.split('{"type":"checkpoint",', 1)[1].split('}', 1)[1]
-                            resources = (before + after).strip()
-
-                        # get embeddings
-                        resources = p.split('Civitai resources:', 1)[1].strip()
-                        while '{"type":"embed",' in resources and '}' in resources:
-                            work = resources.split('{"type":"embed",', 1)[1].split('}', 1)[0]
-                            if '"modelVersionId":' in work and ',' in work:
-                                id = work.split('"modelVersionId":', 1)[1].split(',', 1)[0]
-                                rsc = ImageResources()
-                                rsc.type = 'embed'
-                                rsc.version_id = id
-                                md.resources.append(rsc)
-                            before = resources.split('{"type":"embed",', 1)[0]
-                            after = resources.split('{"type":"embed",', 1)[1].split('}', 1)[1]
-                            resources = (before + after).strip()
-
-                        # extra pass to get loras in different format
-                        resources = p.split('Civitai resources:', 1)[1].strip()
-                        while 'Type = lora }"' in resources and '}' in resources:
-                            work = resources.split('Type = lora }"', 1)[1].split('}', 1)[0]
-                            if '"modelVersionId":' in work:
-                                id = work.split('"modelVersionId":', 1)[1]
-                                found = True
+                    p = command
+
+            # get the rest of the params:
+            if not dream_factory:
+                # single compiled-regex pass over p; matching is
+                # case-insensitive and the first occurrence of each
+                # parameter wins (same as the old split-based code)
+                found = {}
+                for m in A1111_RE.finditer(p):
+                    param = m.group(1).lower()
+                    if param not in found:
+                        found[param] = m.group(2).strip()
+                for param, v in found.items():
+                    if param in A1111_FIELDS:
+                        setattr(md, A1111_FIELDS[param], v)
+                    elif param == 'size':
+                        if 'x' in v:
+                            md.width = v.split('x', 1)[0].strip()
+                            md.height = v.split('x', 1)[1].strip()
+                    elif param == 'sampler':
+                        if v.endswith(' Exponential'):
+                            v = v.replace(' Exponential', '')
+                        if v.endswith(' Karras'):
+                            v = v.replace(' Karras', '')
+                        md.sampler = sys.intern(v)
+                    elif param == 'model':
+                        md.model = extract_model_filename(v)
+
+            # get resources used:
+            if 'Civitai resources:' in p:
+                # option 1
+                # fast path: locate the JSON array once (balanced-bracket
+                # scan) and parse it in a single json.loads call instead
+                # of four substring-scraping passes over the tail of p
+                arr = None
+                start = p.index('Civitai resources:') + len('Civitai resources:')
+                while start < len(p) and p[start] in ' \t':
+                    start += 1
+                if start < len(p) and p[start] == '[':
+                    depth = 0
+                    for i in range(start, len(p)):
+                        if p[i] == '[':
+                            depth += 1
+                        elif p[i] == ']':
+                            depth -= 1
+                            if depth == 0:
                                 try:
-                                    num_id = int(id)
+                                    arr = json_loads(p[start:i+1])
                                 except:
-                                    self.log('Unable to determine lora ID from metadata in ' + md.orig_filename, self.log_to_console)
-                                    found = False
-                                if found:
-                                    weight = 1.0
-                                    if '"weight":' in work and ',' in work:
-                                        w = work.split('"weight":', 1)[1].split(',', 1)[0]
-                                        try:
-                                            weight = float(w)
-                                        except:
-                                            weight = 1.0
-                                    rsc = ImageResources()
-                                    rsc.type = 'lora'
-                                    rsc.version_id = id
-                                    rsc.weight = weight
-                                    md.resources.append(rsc)
-                            before = resources.split('Type = lora }"', 1)[0]
-                            after = resources.split('Type = lora }"', 1)[1].split('}', 1)[1]
-                            resources = (before + after).strip()
-
-                    elif 'Hashes: {' in p:
-                        # option 2
-                        resources = p.split('Hashes: {', 1)[1].strip()
-                        resources = resources.split('}', 1)[0].strip()
-                        while ':' in resources:
-                            while resources.startswith(' ') or resources.startswith('\"'):
-                                resources = resources[1:]
-
-                            type = resources.split('\"', 1)[0].strip('\"').lower()
-                            if ':' in type:
-                                type = type.split(':', 1)[0].strip()
-                            resources = resources.split('\"', 1)[1]
-
-                            while resources.startswith(' ') or resources.startswith(':')  or resources.startswith('\"'):
-                                resources = resources[1:]
-
-                            # handles case where we have something like this in metadata:  Hashes: {"model": ""}
-                            if resources.strip() != '':
-                                hash = resources.split('\"', 1)[0].strip()
-                                resources = resources.split('\"', 1)[1]
-
-                                while resources.startswith(' ') or resources.startswith(','):
-                                    resources = resources[1:]
-
-                                rsc = ImageResources()
-                                rsc.type = type
-                                rsc.hash = hash
-                                md.resources.append(rsc)
-
-                    elif 'Lora hashes: "' in p:
-                        # option 3
-                        resources = p.split('Lora hashes: \"', 1)[1].strip()
-                        resources = resources.split('\"', 1)[0].strip()
-
-                        while ':' in resources:
-                            resources = resources.split(':', 1)[1]
-                            hash = ''
-                            if ',' in resources:
-                                hash = resources.split(',', 1)[0].strip()
-                                resources = resources.split(',', 1)[1]
-                            else:
-                                hash = resources.strip()
-
+                                    arr = None
+                                break
+                if arr is not None:
+                    for res in arr:
+                        if not isinstance(res, dict):
+                            continue
+                        t = str(res.get('type', '')).lower().strip()
+                        id = res.get('modelVersionId', '')
+                        if t in ('lora', 'checkpoint', 'embed') and str(id) != '':
                             rsc = ImageResources()
-                            rsc.type = 'lora'
-                            rsc.hash = hash
+                            rsc.type = t
+                            rsc.version_id = str(id)
+                            if t == 'lora':
+                                try:
+                                    rsc.weight = float(res.get('weight', 1.0))
+                                except:
+                                    rsc.weight = 1.0
                             md.resources.append(rsc)
-
-            # save orig raw versions of prompt/neg prompt
-            md.prompt_raw = md.prompt
-            md.neg_prompt_raw = md.neg_prompt
-
-            self.metadata.update({key:md})
+                else:
+                    # fall back to legacy scraping for the non-JSON variants
+                    decode_civitai_resources_legacy(p, md, logs)
+
+            elif 'Hashes: {' in p:
+                # option 2
+                # one regex pass over the block instead of trimming
+                # leading characters one at a time (each trim
+                # reallocated the whole remaining string)
+                resources = p.split('Hashes: {', 1)[1].split('}', 1)[0]
+                for t, h in HASHES_RE.findall(resources):
+                    h = h.strip()
+                    if h != '':
+                        rsc = ImageResources()
+                        rsc.type = t.split(':', 1)[0].strip().lower()
+                        rsc.hash = h
+                        md.resources.append(rsc)
+
+            elif 'Lora hashes: "' in p:
+                # option 3
+                resources = p.split('Lora hashes: \"', 1)[1].split('\"', 1)[0]
+                for name, h in LORA_HASHES_RE.findall(resources):
+                    rsc = ImageResources()
+                    rsc.type = 'lora'
+                    rsc.hash = h
+                    md.resources.append(rsc)
+
+
+    # save orig raw versions of prompt/neg prompt
+    md.prompt_raw = md.prompt
+    md.neg_prompt_raw = md.neg_prompt
+    return key, md, logs
 
 
 # for organizing image metadata
+# __slots__ drops the per-instance __dict__ (~200 bytes each), which adds
+# up across catalogs with tens of thousands of images
 class ImageMetaData:
+  __slots__ = ('orig_filename', 'orig_filepath', 'raw_metadata', 'prompt',
+    'prompt_raw', 'neg_prompt', 'neg_prompt_raw', 'seed', 'width', 'height',
+    'steps', 'scale', 'strength', 'model', 'hash', 'base_model', 'sampler',
+    'scheduler', 'clip_skip', 'resources')
   def __init__(self):
     self.orig_filename = ''
     self.orig_filepath = ''
@@ -1046,6 +1111,8 @@ class ImageMetaData:
 
 # for organizing resources
 class ImageResources:
+  __slots__ = ('type', 'version_id', 'hash', 'filename', 'resource_name',
+    'base_model', 'weight')
   def __init__(self):
     self.type = ''
     self.version_id = ''
@@ -4,8 +4,11 @@
 import sys
 import os
 import requests
-import shutil
+import threading
+import queue
 import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm.auto import tqdm
 from os.path import exists
 from pathlib import Path
@@ -17,6 +20,13 @@ class Network:
         # backup existing log file & create new one
         self.logfile = os.path.join('logs', 'log.txt')
         os.makedirs('logs', exist_ok = True)
+        # keep a single append-mode handle open instead of re-opening per log line;
+        # writes are queued and drained by a background thread so the download
+        # path never blocks on log file I/O
+        self._logf = open(self.logfile, 'a', encoding="utf-8", buffering = 64*1024)
+        self._log_q = queue.Queue()
+        self._log_thread = threading.Thread(target = self._log_worker, daemon = True)
+        self._log_thread.start()
 
         self.api_key = config.get('api_key')
         self.request_delay = config.get('request_delay')
@@ -24,20 +34,39 @@ class Network:
         self.max_file_size = config.get('max_file_size')
 
         self.last_request_time = time.perf_counter() - self.request_delay
+        # serializes the pause/timestamp pair when downloads run in parallel threads
+        self.request_lock = threading.Lock()
+
+        # one pooled session for all civitai.com traffic; keep-alive
+        # amortizes the TCP/TLS handshake across downloads and transient
+        # server errors retry with backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = 8, pool_maxsize = 8,
+            max_retries = Retry(total = 3, backoff_factor = 0.5, status_forcelist = (500, 502, 503, 504)))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # set the API key once instead of rebuilding headers per request
+        if self.api_key != '':
+            self.session.headers.update({'Authorization': 'Bearer ' + self.api_key})
 
         # list of civitai.com version IDs of resources that should not be downloaded
         self.do_not_download = self.init_do_not_download()
 
     # waits the minimum specified time between requests, if necessary
+    # one computed sleep instead of polling in 100ms ticks, which added up
+    # to 100ms of jitter per request
     def network_pause(self):
         #self.log('Waiting until ' + str(self.request_delay) + ' secs have passed since last request...')
-        while time.perf_counter() - self.last_request_time < self.request_delay:
-            time.sleep(0.1)
+        remaining = self.request_delay - (time.perf_counter() - self.last_request_time)
+        if remaining > 0:
+            time.sleep(remaining)
 
 
     # sets up list of resources that the user does not want to download
+    # kept as a set of ints: int hashing is cheaper than string hashing, and
+    # the set stays mutable because oversize files are added to it at runtime
     def init_do_not_download(self):
-        ids = []
+        ids = set()
         if self.file_exists('cache', 'do_not_download.txt'):
             pf = os.path.join('cache', 'do_not_download.txt')
             file = TextFile(pf)
@@ -45,78 +74,124 @@ class Network:
                 self.log('Caching "do not download" list from ' + str(pf) + '...', False)
                 while file.lines_remaining() > 0:
                     line = file.next_line().strip()
+                    # tolerate any junk in this hand-edited file, same as
+                    # the is_blocked/block helpers
                     try:
-                        int(line)
-                    except:
+                        ids.add(int(line))
+                    except ValueError:
                         pass
-                    else:
-                        ids.append(line)
         self.log('Cached ' + str(len(ids)) + ' resource IDs that will not be downloaded.', False)
         return ids
 
 
+    # returns True if the given version ID is on the do-not-download list
+    # (IDs arrive as strings from URLs/metadata, so normalize here)
+    def is_blocked(self, vid):
+        try:
+            return int(str(vid).strip()) in self.do_not_download
+        except ValueError:
+            return False
+
+
+    # adds the given version ID to the do-not-download list for this run
+    def block(self, vid):
+        try:
+            self.do_not_download.add(int(str(vid).strip()))
+        except ValueError:
+            pass
+
+
+    # issues a single HEAD request for the given url and returns the reported
+    # file size in bytes, or None if it couldn't be determined
+    # cheaper than opening a full GET just to abort on Content-Length
+    def check_size(self, url):
+        with self.request_lock:
+            self.network_pause()
+            self.last_request_time = time.perf_counter()
+        try:
+            r = self.session.head(url, allow_redirects = True)
+        except requests.RequestException:
+            return None
+        size = r.headers.get('Content-Length', '')
+        try:
+            return int(size)
+        except ValueError:
+            return None
+
+    # logs the appropriate error for a failed download response
+    def log_download_error(self, r, url):
+        if 'reason=download-auth' in r.url or r.status_code == 401:
+            self.log('Error: an API key is required to download from ' + url + ' (response code: ' + str(r.status_code) + ')!')
+        elif r.status_code == 403:
+            self.log('Error: the model at this URL is currently in early-access and unavailable: ' + url + ' (response code: ' + str(r.status_code) + ')!')
+        else:
+            self.log('Error: unable to download from ' + url + ' (response code: ' + str(r.status_code) + ')!')
+
+    # resolves the output filename against the Content-Disposition header;
+    # returns '' if no filename could be determined
+    def resolve_local_filename(self, r, local_filename):
+        if 'Content-Disposition' in r.headers:
+            filename = r.headers.get('Content-Disposition')
+            remote_filename = filename.partition('filename=')[2].strip('\"')
+            if remote_filename != '':
+                if local_filename == '':
+                    local_filename = remote_filename
+                elif local_filename != remote_filename:
+                    self.log('Warning: remote filename (' + remote_filename  + ') doesn\'t match expected filename (' + local_filename + ')!')
+        return local_filename
+
     # downloads a file from the given url
     # local_filename can be optionally specified, otherwise will attempt to discern it
     def download_file(self, url, local_filepath='', local_filename=''):
         vid = url.rsplit('/', 1)[1]
         # check do not download list
-        if vid in self.do_not_download:
+        if self.is_blocked(vid):
             self.log('This ID ('+ str(vid) + ') is in the \'do not download\' list; aborting download!')
             return
-        # check if the designated ouput file already exists
+        # bail before opening a connection if the requested output file exists
         if self.file_exists(local_filepath, local_filename):
             self.log('Error: ' + os.path.join(local_filepath, local_filename) + ' already exists; aborting download!')
-        else:
+            return local_filename
+        requested_filename = local_filename
+        with self.request_lock:
             self.network_pause()
-            # add API key to the request header if present
-            headers = {}
-            if self.api_key != '':
-                headers = {
-                    'Authorization': f'Bearer {self.api_key}',
-                }
-            # make the request
             self.last_request_time = time.perf_counter()
-            with requests.get(url, stream=True, headers=headers) as r:
-                if r.status_code == 200:
-                    # attempt to get the filename from the response header
-                    if 'Content-Disposition' in r.headers:
-                        filename = r.headers.get('Content-Disposition')
-                        if 'filename=' in filename:
-                            remote_filename = filename.split('filename=', 1)[1].strip('\"')
-                            if local_filename == '':
-                                local_filename = remote_filename
-                            else:
-                                if local_filename != remote_filename:
-                                    self.log('Warning: remote filename (' + remote_filename  + ') doesn\'t match expected filename (' + local_filename + ')!')
-                    if local_filename != '':
-                        full_output_path = os.path.join(local_filepath, local_filename)
-                        # check if the designated ouput file already exists
-                        if self.file_exists(local_filepath, local_filename):
-                            self.log('Error: ' + full_output_path  + ' already exists; aborting download!')
-                        else:
-                            if local_filepath != '':
-                                # create output dir if necessary
-                                os.makedirs(local_filepath, exist_ok = True)
-                            file_size = int(r.headers.get('Content-Length', 0))
-                            if (self.max_file_size == 0) or (file_size <= self.max_file_size):
-                                # start the download
-                                self.log('Downloading from ' + url + '...')
-                                desc = "(Unknown total file size)" if file_size == 0 else ""
-                                with tqdm.wrapattr(r.raw, "read", total=file_size, desc=desc) as r_raw:
-                                    with open(full_output_path, 'wb') as f:
-                                        shutil.copyfileobj(r_raw, f)
-                            else:
-                                self.log('Warning: ' + local_filename + ' (' + str(file_size) + ' bytes) is over the maximum file size limit of ' + str(self.max_file_size) + ' bytes; download aborted!')
-                    else:
-                        self.log('Error: unable to determine output filename when downloading from ' + url + '; aborting download!')
-                else:
-                    local_filename = ''
-                    if 'reason=download-auth' in r.url or r.status_code == 401:
-                        self.log('Error: an API key is required to download from ' + url + ' (response code: ' + str(r.status_code) + ')!')
-                    elif r.status_code == 403:
-                        self.log('Error: the model at this URL is currently in early-access and unavailable: ' + url + ' (response code: ' + str(r.status_code) + ')!')
-                    else:
-                        self.log('Error: unable to download from ' + url + ' (response code: ' + str(r.status_code) + ')!')
+        # make the request (the session carries the API key header)
+        with self.session.get(url, stream=True) as r:
+            if r.status_code != 200:
+                self.log_download_error(r, url)
+                return ''
+            # attempt to get the filename from the response header
+            local_filename = self.resolve_local_filename(r, local_filename)
+            if local_filename == '':
+                self.log('Error: unable to determine output filename when downloading from ' + url + '; aborting download!')
+                return ''
+            full_output_path = os.path.join(local_filepath, local_filename)
+            # only re-stat if the filename changed after the pre-request check
+            if local_filename != requested_filename and self.file_exists(local_filepath, local_filename):
+                self.log('Error: ' + full_output_path  + ' already exists; aborting download!')
+                return local_filename
+            file_size = int(r.headers.get('Content-Length', 0))
+            if self.max_file_size > 0 and file_size > self.max_file_size:
+                # drop the connection now rather than letting the
+                # with-block drain a multi-GB body back to the pool
+                r.close()
+                self.log('Warning: ' + local_filename + ' (' + str(file_size) + ' bytes) is over the maximum file size limit of ' + str(self.max_file_size) + ' bytes; download aborted!')
+                return local_filename
+            if local_filepath != '':
+                # create output dir if necessary
+                os.makedirs(local_filepath, exist_ok = True)
+            # start the download
+            # stream in 1 MiB chunks; the 16 KiB default
+            # means ~150k read/write syscalls per GB
+            self.log('Downloading from ' + url + '...')
+            desc = "(Unknown total file size)" if file_size == 0 else ""
+            with tqdm(total = file_size, unit = 'B', unit_scale = True, desc = desc) as pbar:
+                with open(full_output_path, 'wb') as f:
+                    for chunk in r.iter_content(chunk_size = 1024*1024):
+                        if chunk:
+                            f.write(chunk)
+                            pbar.update(len(chunk))
         return local_filename
 
     # returns true if the given path/filename combo already exists, false otherwise
@@ -132,5 +207,27 @@ class Network:
         output = '[Network] > ' + str(line)
         if console:
             print(output)
-        with open(self.logfile, 'a', encoding="utf-8") as f:
-            f.write(output + '\n')
+        self._log_q.put(output)
+
+    # drains queued log lines to the file; exits when None is queued
+    def _log_worker(self):
+        while True:
+            line = self._log_q.get()
+            if line is None:
+                break
+            self._logf.write(line + '\n')
+            # flush whenever we've caught up rather than per line
+            if self._log_q.empty():
+                self._logf.flush()
+
+    # stops the log writer, then closes the log file and pooled session
+    def close(self):
+        if self._log_thread.is_alive():
+            self._log_q.put(None)
+            self._log_thread.join()
+        if not self._logf.closed:
+            self._logf.close()
+        self.session.close()
+
+    def __del__(self):
+        self.close()
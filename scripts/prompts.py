@@ -3,20 +3,181 @@
 
 import sys
 import os
+import re
 import glob
-from tqdm.auto import tqdm
+from functools import lru_cache
 from os.path import exists
 from pathlib import Path
 from datetime import datetime as dt
 import scripts.utils as utils
 from scripts.images import Images, ImageMetaData, ImageResources
 
+# matches a single <lora:...> reference; group 1 is everything between
+# '<lora:' and the closing '>'
+LORA_RE = re.compile(r'<lora:([^>]*)>')
+
+# splits a comma-separated config value into lowercased, stripped entries
+def parse_csv(value):
+    if not value:
+        return []
+    return [x.lower().strip() for x in value.split(',')]
+
+# placeholders recognized in user-supplied prompt templates
+TEMPLATE_TOKENS = ('ref_num', 'filename', 'filepath', 'raw_metadata', 'model',
+    'seed', 'sampler', 'clip_skip', 'width', 'height', 'steps', 'scale',
+    'strength', 'neg_prompt', 'neg_prompt_raw', 'prompt', 'prompt_raw',
+    'base_model', 'model_hash')
+
+# matches any [placeholder]; longest-first alternation so e.g. [prompt_raw]
+# isn't half-matched by [prompt]
+TEMPLATE_RE = re.compile(r'\[(' + '|'.join(sorted(TEMPLATE_TOKENS, key = len, reverse = True)) + r')\]', re.IGNORECASE)
+
+# supported Auto1111 samplers as of 2024-07-02
+AUTO1111_SAMPLERS = ['DDIM',
+    'DPM adaptive',
+    'DPM fast',
+    'DPM++ 2M',
+    'DPM++ 2M SDE',
+    'DPM++ 2M SDE Heun',
+    'DPM++ 2S a',
+    'DPM++ 3M SDE',
+    'DPM++ SDE',
+    'DPM2',
+    'DPM2 a',
+    'Euler',
+    'Euler a',
+    'Heun',
+    'LCM',
+    'LMS',
+    'PLMS',
+    'Restart',
+    'UniPC'
+]
+
+# lowercased sampler name -> canonical Auto1111 name; canonical names map to
+# themselves, known aliases map to their approximate Auto1111 equivalents
+# (one dict probe per lookup instead of a linear scan + if/elif ladder)
+SAMPLER_MAP = {s.lower() : s for s in AUTO1111_SAMPLERS}
+SAMPLER_MAP.update({
+    'dpmpp_2m_sde_gpu' : 'DPM++ 2M SDE',
+    'dpmpp_2m_karras' : 'DPM++ 2M',
+    'dpmpp_3m_sde' : 'DPM++ 3M SDE',
+    'ddim_ddim_uniform' : 'DDIM',
+    'dpm++ 2m sde sgmuniform' : 'DPM++ 2M SDE',
+    'dpmpp_sde_karras' : 'DPM++ SDE',
+    'dpmpp_2s_ancestral_karras' : 'DPM++ 2S a',
+    'dpm++ 2m sde gpu' : 'DPM++ 2M SDE',
+    'dpmpp_3m_sde_gpu_karras' : 'DPM++ 3M SDE',
+    'dpmpp_2m_alt_karras' : 'DPM++ 2M',
+    'dpmpp_3m_sde_gpu' : 'DPM++ 3M SDE',
+    'euler_max' : 'Euler',
+    'dpmpp_2m_turbo' : 'DPM++ 2M',
+    'dpm++ 2m sde ays' : 'DPM++ 2M SDE',
+    'euler a turbo' : 'Euler a',
+    'dpmpp_sde_sgm_uniform' : 'DPM++ SDE',
+    'dpm++ 2m sgmuniform' : 'DPM++ 2M',
+    'dpmpp_3m_sde_karras' : 'DPM++ 3M SDE',
+    'dpmpp_2m_sde_karras' : 'DPM++ 2M SDE',
+    'ddim_sgm_uniform' : 'DDIM',
+    'dpm++ 2m turbo' : 'DPM++ 2M',
+    'dpmpp_sde' : 'DPM++ SDE',
+    'dpmpp_sde_gpu_karras' : 'DPM++ SDE',
+    'dpm_2_turbo' : 'DPM2',
+    'ddpm' : 'DPM2',
+    'euler_ancestral' : 'Euler a',
+    'dpmpp_3m_sde_gpu_sgm_uniform' : 'DPM++ 3M SDE',
+    'dpmpp_2m_sde_gpu_karras' : 'DPM++ 2M SDE',
+    'euler a sgmuniform' : 'Euler a',
+    'euler sgmuniform' : 'Euler'
+    #'sa solver' : ''
+})
+
+# official supported/popular base resolutions per platform, as
+# (aspect ratio, (width, height)) pairs built once at import time:
+# SD 1.5: 512x512, 640x512, 768x512, 896x512
+SD15_RES_TABLE = ((1.0000, (512, 512)), (1.2500, (640, 512)), (1.5000, (768, 512)), (1.7500, (896, 512)))
+# SD 2.0/2.1: 768x768, 896x768, 1024x768, 1152x768, 1280x768
+SD21_RES_TABLE = ((1.0000, (768, 768)), (1.1667, (896, 768)), (1.3333, (1024, 768)), (1.5000, (1152, 768)), (1.6667, (1280, 768)))
+# SDXL & derivatives: 1024x1024, 1152x896, 1216x832, 1344x768, 1536x640
+SDXL_RES_TABLE = ((1.0000, (1024, 1024)), (1.2857, (1152, 896)), (1.4615, (1216, 832)), (1.7500, (1344, 768)), (2.4000, (1536, 640)))
+# people generate square SD 1.5 images at various sizes
+SD15_SQUARE_SIZES = (512, 640, 768)
+
+# given a resolution, returns a new resolution closest to an official supported base resolution
+# for the specified platform
+# memoized: a metadata set dumped from a single UI only contains a handful of
+# unique (width, height, platform) combos, so repeat calls are a dict lookup
+@lru_cache(maxsize = 256)
+def fix_image_resolution(width, height, platform='sdxl 1.0'):
+    res = (width, height)
+    try:
+        w = int(width)
+        h = int(height)
+    except:
+        #print('Error: width/height are not integers!')
+        return res
+
+    # check for invalid/zero resolution
+    if w == 0 or h == 0:
+        return res
+
+    # get aspect ratio of user-supplied resolution
+    width_larger = True
+    aspect_ratio = w / h
+    if h > w:
+        width_larger = False
+        aspect_ratio = h / w
+
+    platform = platform.lower().strip()
+    if platform.startswith('sd 1.5'):
+        table = SD15_RES_TABLE
+    elif platform.startswith('sd 2.1'):
+        table = SD21_RES_TABLE
+    else:
+        # assume SDXL or derivitive
+        table = SDXL_RES_TABLE
+
+    # find the closest official supported a/r
+    # (explicit scan; no key-lambda allocated per call)
+    closest_ar, res = table[0]
+    closest_diff = abs(closest_ar - aspect_ratio)
+    for ar, size in table[1:]:
+        diff = abs(ar - aspect_ratio)
+        if diff < closest_diff:
+            closest_diff = diff
+            closest_ar = ar
+            res = size
+
+    if table is SD15_RES_TABLE and closest_ar == 1.0:
+        # square SD 1.5 image; snap to whichever common size is nearest
+        closest_size = SD15_SQUARE_SIZES[0]
+        closest_diff = abs(closest_size - w)
+        for size in SD15_SQUARE_SIZES[1:]:
+            diff = abs(size - w)
+            if diff < closest_diff:
+                closest_diff = diff
+                closest_size = size
+        res = (closest_size, closest_size)
+
+    # flip the width/height if the height was the larger original dimension
+    if not width_larger:
+        res = (res[1], res[0])
+
+    #print('\nPlatform: ' + platform)
+    #print('User resolution: ' + width + 'x' + height)
+    #print('User aspect ratio: ' + str(aspect_ratio))
+    #print('Closest official ratio: ' + str(closest_ar))
+    #print('Final resolution: ' + str(res[0]) + 'x' + str(res[1]))
+    return res
+
 # Handles outputting found image metadata as DF .prompts files
 class Prompts:
     # config is a dict of options prepared by the Config class
     def __init__(self, images, image_metadata, config):
         self.logfile = os.path.join('logs', 'log.txt')
         os.makedirs('logs', exist_ok = True)
+        # keep a single append-mode handle open instead of re-opening per log line
+        self._logf = open(self.logfile, 'a', encoding="utf-8", buffering = 64*1024)
 
         self.images = images
         self.metadata = image_metadata
@@ -29,44 +190,17 @@ class Prompts:
         self.fix_resolution = config.get('fix_resolution')
 
         # set up list of base models to include
-        self.base_list = []
-        if config.get('only_include_base') != '':
-            self.base_list = config.get('only_include_base').split(',')
-            temp = []
-            for b in self.base_list.copy():
-                b = b.lower().strip()
-                temp.append(b)
-            self.base_list = temp
-
-        # set up list of words to exclude from prompts if found
-        self.word_filter_list = []
-        if config.get('word_filter_list') != '':
-            self.word_filter_list = config.get('word_filter_list').split(',')
-            temp = []
-            for w in self.word_filter_list.copy():
-                w = w.lower().strip()
-                temp.append(w)
-            self.word_filter_list = temp
-
-        # set up list of words to exclude from negative prompts if found
-        self.neg_word_filter_list = []
-        if config.get('neg_word_filter_list') != '':
-            self.neg_word_filter_list = config.get('neg_word_filter_list').split(',')
-            temp = []
-            for w in self.neg_word_filter_list.copy():
-                w = w.lower().strip()
-                temp.append(w)
-            self.neg_word_filter_list = temp
+        # (frozenset: only ever used for membership tests)
+        self.base_list = frozenset(parse_csv(config.get('only_include_base')))
+
+        # set up lists of words to exclude from prompts/negative prompts if found
+        # (tuples: immutable & slightly faster to iterate per-prompt)
+        self.word_filter_list = tuple(parse_csv(config.get('word_filter_list')))
+        self.neg_word_filter_list = tuple(parse_csv(config.get('neg_word_filter_list')))
 
         # set up list of loras to exclude from prompts if found
-        self.lora_filter_list = []
-        if config.get('lora_filter_list') != '':
-            self.lora_filter_list = config.get('lora_filter_list').split(',')
-            temp = []
-            for l in self.lora_filter_list.copy():
-                l = l.lower().strip()
-                temp.append(l)
-            self.lora_filter_list = temp
+        # (frozenset: only ever used for membership tests)
+        self.lora_filter_list = frozenset(parse_csv(config.get('lora_filter_list')))
 
         self.output_template = config.get('output_template')
         self.output_header = config.get('output_header')
@@ -76,40 +210,12 @@ class Prompts:
         self.output_save_as = utils.ireplace('[date]', dt.now().strftime('%Y-%m-%d'), self.output_save_as)
         self.output_save_as = utils.ireplace('[time]', dt.now().strftime('%H-%M-%S'), self.output_save_as)
 
-        # supported Auto1111 samplers as of 2024-07-02
-        self.auto1111_samplers = ['DDIM',
-            'DPM adaptive',
-            'DPM fast',
-            'DPM++ 2M',
-            'DPM++ 2M SDE',
-            'DPM++ 2M SDE Heun',
-            'DPM++ 2S a',
-            'DPM++ 3M SDE',
-            'DPM++ SDE',
-            'DPM2',
-            'DPM2 a',
-            'Euler',
-            'Euler a',
-            'Heun',
-            'LCM',
-            'LMS',
-            'PLMS',
-            'Restart',
-            'UniPC'
-        ]
-
 
     # standard/suggested method of running through task manifest
     # will create final clean prompts that are ready for write_prompt_file()
     def manifest(self):
         self.filter_unwanted_base_prompts()
-        self.fix_lora_refs()
-        self.add_missing_lora_refs()
-        self.fix_embedding_refs()
-        self.enforce_limits()
-        self.check_samplers()
-        self.remove_filter_words()
-        self.remove_neg_filter_words()
+        self.apply_per_item_fixes()
         self.remove_dupes()
         self.remove_empty(5)
         self.check_for_main_model()
@@ -117,6 +223,137 @@ class Prompts:
         self.remove_filter_loras()
 
 
+    # applies all of the independent per-prompt transforms in a single pass
+    # over the metadata: lora path fixes, missing lora refs, embedded URN
+    # replacement, user-specified limits, sampler translation and word
+    # filters (one dict traversal instead of seven)
+    def apply_per_item_fixes(self):
+        self.log('Applying per-prompt fixes...')
+        # config-derived limits don't change per item; convert them once
+        min_steps = int(self.min_steps or 0)
+        max_steps = int(self.max_steps or 0)
+        min_scale = float(self.min_scale or 0)
+        max_scale = float(self.max_scale or 0)
+        check_steps = min_steps > 0 or max_steps > 0
+        check_scale = min_scale > 0 or max_scale > 0
+        lora_fixes = 0
+        lora_additions = 0
+        urn_replacements = 0
+        limit_changes = 0
+        sampler_subs = 0
+        word_removals = 0
+        neg_word_removals = 0
+
+        def fix_lora(match):
+            nonlocal lora_fixes
+            work = match.group(1)
+            # keep only the filename, remove paths
+            if '\\' in work:
+                work = work.rsplit('\\', 1)[1]
+                lora_fixes += 1
+            if '/' in work:
+                work = work.rsplit('/', 1)[1]
+                lora_fixes += 1
+            # added 2024-12-23 BK: prompts from civitai often have an
+            # extraneous space in lora declarations before the extension
+            while '. safetensors' in work:
+                work = work.replace('. safetensors', '.safetensors')
+            return '<lora:' + work + '>'
+
+        for k, v in self.metadata.items():
+            self.log('Working on ' + v.orig_filename + '...', False)
+
+            # remove path references in prompt lora declarations
+            v.prompt = LORA_RE.sub(fix_lora, v.prompt)
+
+            # add lora references that appear in resources metadata
+            # but are absent from the actual prompt; collect the names already
+            # referenced once instead of re-lowercasing the prompt per resource
+            if v.resources:
+                existing = {m.group(1).split(':', 1)[0].lower() for m in LORA_RE.finditer(v.prompt)}
+                for r in v.resources:
+                    if 'lora' in r.type and r.filename != '':
+                        name = r.filename.rsplit('.', 1)[0]
+                        if name.lower() not in existing:
+                            # this reference is missing; add it
+                            v.prompt += ' <lora:' + name + ':' + str(r.weight) + '>'
+                            existing.add(name.lower())
+                            lora_additions += 1
+
+            # replace embedded URN references with the embedding name
+            temp = v.prompt
+            v.prompt = self.replace_embedded_urns(v.prompt)
+            if temp != v.prompt:
+                urn_replacements += 1
+            temp = v.neg_prompt
+            v.neg_prompt = self.replace_embedded_urns(v.neg_prompt)
+            if temp != v.neg_prompt:
+                urn_replacements += 1
+
+            # adjust parameters so values are not outside of user-specified limits
+            if check_steps and v.steps != '':
+                steps = int(v.steps)
+                if min_steps > 0 and steps < min_steps:
+                    v.steps = str(self.min_steps)
+                    steps = min_steps
+                    limit_changes += 1
+                if max_steps > 0 and steps > max_steps:
+                    v.steps = str(self.max_steps)
+                    limit_changes += 1
+            if check_scale and v.scale != '':
+                scale = float(v.scale)
+                if min_scale > 0 and scale < min_scale:
+                    v.scale = str(self.min_scale)
+                    scale = min_scale
+                    limit_changes += 1
+                if max_scale > 0 and scale > max_scale:
+                    v.scale = str(self.max_scale)
+                    limit_changes += 1
+            if self.fix_resolution:
+                new_res = self.fix_image_resolution(v.width, v.height, v.base_model)
+                if new_res[0] != v.width:
+                    v.width = str(new_res[0])
+                    v.height = str(new_res[1])
+                    limit_changes += 1
+
+            # translate unsupported samplers to their Auto1111 equivalents
+            sampler = self.verify_sampler(v.sampler)
+            if sampler != v.sampler:
+                v.sampler = sampler
+                sampler_subs += 1
+
+            # remove filter words from the prompt
+            if len(self.word_filter_list) > 0:
+                # lowercase once per prompt instead of once per filter word
+                lp = v.prompt.lower()
+                for fw in self.word_filter_list:
+                    if fw in lp:
+                        before = len(v.prompt)
+                        v.prompt = utils.sanitize_prompt(utils.word_replace(fw, v.prompt))
+                        if before != len(v.prompt):
+                            word_removals += 1
+                        lp = v.prompt.lower()
+
+            # remove filter words from the negative prompt
+            if len(self.neg_word_filter_list) > 0:
+                lp = v.neg_prompt.lower()
+                for fw in self.neg_word_filter_list:
+                    if fw in lp:
+                        before = len(v.neg_prompt)
+                        v.neg_prompt = utils.sanitize_prompt(utils.word_replace(fw, v.neg_prompt))
+                        if before != len(v.neg_prompt):
+                            neg_word_removals += 1
+                        lp = v.neg_prompt.lower()
+
+        self.log('Fixed ' + str(lora_fixes) + ' lora reference(s) containing broken paths...')
+        self.log('Added ' + str(lora_additions) + ' lora reference(s) that were missing from prompts...')
+        self.log('Made ' + str(urn_replacements) + ' URN link replacements...')
+        self.log('Made ' + str(limit_changes) + ' adjustment(s) to prompt parameters...')
+        self.log('Substituted ' + str(sampler_subs) + ' unsupported sampler name(s) for their approximate Auto1111 equivalents...')
+        self.log('Removed ' + str(word_removals) + ' occurances of filter word(s) in prompts...')
+        self.log('Removed ' + str(neg_word_removals) + ' occurances of filter word(s) in negative prompts...')
+
+
     # if no main model is populated, check resources
     # if only one model is found, assume it's the main
     def check_for_main_model(self):
@@ -154,233 +391,70 @@ class Prompts:
         self.metadata = ordered_metadata
 
 
-    # returns a dict (version_id : filename) of referenced lora resources
+    # yields (version_id, resource) pairs for referenced resources of the
+    # given types, without materializing a dict
     # types is a list of the types of resources to return (e.g. lora, embed, model)
-    def get_referenced_resources(self, types):
-        resources = {}
+    def iter_referenced_resources(self, types):
         # if a single resource was passed as a string instead of list, convert it
         if isinstance(types, str):
-            t = types
-            types = []
-            types.append(t)
+            types = [types]
         # make sure everything is lowercase without any whitespace padding
-        for t in types:
-            t = t.lower().strip()
+        # (the old loop rebound its local without writing back, so mixed-case
+        # inputs never matched); a frozenset also makes the membership test O(1)
+        types = frozenset(t.lower().strip() for t in types)
 
         for k, v in self.metadata.items():
             for r in v.resources:
                 if r.type.lower().strip() in types and r.filename != '' and r.version_id != '':
-                    resources[r.version_id] = r
-        return resources
-
-
-    # removes filter words if they appear in prompts
-    def check_samplers(self):
-        self.log('Checking prompts for unsupported samplers:')
-        count = 0
-        for k, v in self.metadata.items():
-            sampler = self.verify_sampler(v.sampler)
-            if sampler != v.sampler:
-                v.sampler = sampler
-                count += 1
-        self.log('Substituted ' + str(count) + ' unsupported sampler name(s) for their approximate Auto1111 equivalents...')
-
-
-    # removes filter words if they appear in prompts
-    def remove_filter_words(self):
-        if len(self.word_filter_list) > 0:
-            self.log('Checking prompts for filter words:')
-            count = 0
-            for k, v in self.metadata.items():
-                for fw in self.word_filter_list:
-                    if fw in v.prompt.lower():
-                        before = len(v.neg_prompt)
-                        # try to remove the filter word
-                        v.prompt = utils.word_replace(fw, v.prompt)
-                        # re-sanitize
-                        v.prompt = utils.sanitize_prompt(v.prompt)
-                        if before != len(v.neg_prompt):
-                            count += 1
-            self.log('Removed ' + str(count) + ' occurances of filter word(s) in prompts...')
+                    yield r.version_id, r
 
-
-    # removes filter words if they appear in negative prompts
-    def remove_neg_filter_words(self):
-        if len(self.neg_word_filter_list) > 0:
-            self.log('Checking negative prompts for filter words:')
-            count = 0
-            for k, v in self.metadata.items():
-                for fw in self.neg_word_filter_list:
-                    if fw in v.neg_prompt.lower():
-                        before = len(v.neg_prompt)
-                        # try to remove the filter word
-                        v.neg_prompt = utils.word_replace(fw, v.neg_prompt)
-                        # re-sanitize
-                        v.neg_prompt = utils.sanitize_prompt(v.neg_prompt)
-                        if before != len(v.neg_prompt):
-                            count += 1
-            self.log('Removed ' + str(count) + ' occurances of filter word(s) in negative prompts...')
+    # returns a dict (version_id : resource) of referenced resources
+    # types is a list of the types of resources to return (e.g. lora, embed, model)
+    def get_referenced_resources(self, types):
+        return dict(self.iter_referenced_resources(types))
 
 
     # removes unwanted loras from prompts if they appear in the filter list
+    # one LORA_RE.sub pass per prompt instead of the old sentinel-rewrite
+    # loop, whose inner filter scan also let a later non-matching filter
+    # word undo a removal made by an earlier one
     def remove_filter_loras(self):
         if len(self.lora_filter_list) > 0:
             self.log('Checking prompts for unwanted LoRA references:')
             count = 0
+            remove_all = 'all' in self.lora_filter_list
+
+            def filter(match):
+                nonlocal count
+                work = match.group(1).split(':', 1)[0]
+                if remove_all or work.lower().strip() in self.lora_filter_list:
+                    # remove this lora
+                    count += 1
+                    return ''
+                # this lora is fine; keep it
+                return match.group(0)
+
             for k, v in self.metadata.items():
-                temp = v.prompt
-                while '<lora:' in temp and '>' in temp:
-                    # save portions of prompt that are before/after lora ref
-                    before = temp.split('<lora:', 1)[0]
-                    after = temp.split('<lora:', 1)[1].split('>', 1)[1]
-                    # this is inside a lora declaration
-                    work = temp.split('<lora:', 1)[1].split('>', 1)[0]
-                    work = work.split(':', 1)[0]
-                    for fl in self.lora_filter_list:
-                        if fl == work.lower().strip() or fl.lower().strip() == 'all':
-                            # remove this lora
-                            temp = before + after
-                            count += 1
-                        else:
-                            # this lora is fine; keep it
-                            temp = before + '<zzzora:' + work + '>' + after
-                v.prompt = temp.replace('<zzzora:', '<lora:')
-                v.prompt = utils.sanitize_prompt(v.prompt)
+                v.prompt = utils.sanitize_prompt(LORA_RE.sub(filter, v.prompt))
             self.log('Removed ' + str(count) + ' occurances of unwanted LoRA(s) in prompts...')
 
 
-    # adjusts metadata parameters so values are not outside of user-specified limits
-    def enforce_limits(self):
-        self.log('Checking prompt parameters for values outside user-specified limits:')
-        changes = 0
-        for k, v in self.metadata.items():
-            if v.steps != '' and int(self.min_steps) > 0 and int(v.steps) < int(self.min_steps):
-                v.steps = str(self.min_steps)
-                changes += 1
-            if v.steps != '' and int(self.max_steps) > 0 and int(v.steps) > int(self.max_steps):
-                v.steps = str(self.max_steps)
-                changes += 1
-            if v.scale != '' and float(self.min_scale) > 0 and float(v.scale) < float(self.min_scale):
-                v.scale = str(self.min_scale)
-                changes += 1
-            if v.scale != '' and float(self.max_scale) > 0 and float(v.scale) > float(self.max_scale):
-                v.scale = str(self.max_scale)
-                changes += 1
-            if self.fix_resolution:
-                new_res = self.fix_image_resolution(v.width, v.height, v.base_model)
-                if new_res[0] != v.width:
-                    v.width = str(new_res[0])
-                    v.height = str(new_res[1])
-                    changes += 1
-        self.log('Made ' + str(changes) + ' adjustment(s) to prompt parameters...')
-
-
     # given a resolution, returns a new resolution closest to an official supported base resolution
     # for the specified platform
     def fix_image_resolution(self, width, height, platform='sdxl 1.0'):
-        res = [width, height]
-        try:
-            int(width)
-            int(height)
-        except:
-            #print('Error: width/height are not integers!')
-            return res
-
-        w = int(width)
-        h = int(height)
-
-        # check for invalid/zero resolution
-        if w == 0 or h == 0:
-            return res
-
-        # get aspect ratio of user-supplied resolution
-        width_larger = True
-        aspect_ratio = w / h
-        if h > w:
-            width_larger = False
-            aspect_ratio = h / w
-
-        # find the closest official supported a/r
-        if platform.lower().strip().startswith('sd 1.5'):
-            # SD 1.5 supported/popular resolutions:
-            # 512x512, 640x512, 768x512, 896x512
-            supported_ar = [1.0000, 1.2500, 1.5000, 1.7500]
-            closest_ar = min(supported_ar, key=lambda x:abs(x-aspect_ratio))
-            if closest_ar == supported_ar[0]:
-                # people generate square SD 1.5 images at various sizes
-                square_sizes = [512, 640, 768]
-                closest_size = min(square_sizes, key=lambda x:abs(x-w))
-                res = [closest_size, closest_size]
-            elif closest_ar == supported_ar[1]:
-                res = [640, 512]
-            elif closest_ar == supported_ar[2]:
-                res = [768, 512]
-            elif closest_ar == supported_ar[3]:
-                res = [896, 512]
-
-        elif platform.lower().strip().startswith('sd 2.1'):
-            # SD 2.0/2.1 supported/popular resolutions:
-            # 768x768, 896x768, 1024x768, 1152x768, 1280x768
-            supported_ar = [1.0000, 1.1667, 1.3333, 1.5000, 1.6667]
-            closest_ar = min(supported_ar, key=lambda x:abs(x-aspect_ratio))
-            if closest_ar == supported_ar[0]:
-                res = [768, 768]
-            elif closest_ar == supported_ar[1]:
-                res = [896, 768]
-            elif closest_ar == supported_ar[2]:
-                res = [1024, 768]
-            elif closest_ar == supported_ar[3]:
-                res = [1152, 768]
-            elif closest_ar == supported_ar[4]:
-                res = [1280, 768]
-
-        else:
-            # assume SDXL or derivitive, supported resolutions:
-            # 1024x1024, 1152x896, 1216x832, 1344x768, 1536x640
-            supported_ar = [1.0000, 1.2857, 1.4615, 1.7500, 2.4000]
-            closest_ar = min(supported_ar, key=lambda x:abs(x-aspect_ratio))
-            if closest_ar == supported_ar[0]:
-                res = [1024, 1024]
-            elif closest_ar == supported_ar[1]:
-                res = [1152, 896]
-            elif closest_ar == supported_ar[2]:
-                res = [1216, 832]
-            elif closest_ar == supported_ar[3]:
-                res = [1344, 768]
-            elif closest_ar == supported_ar[4]:
-                res = [1536, 640]
-
-        # flip the width/height if the height was the larger original dimension
-        if not width_larger:
-            res.reverse()
-
-        #print('\nPlatform: ' + platform)
-        #print('User resolution: ' + width + 'x' + height)
-        #print('User aspect ratio: ' + str(aspect_ratio))
-        #print('Closest official ratio: ' + str(closest_ar))
-        #print('Final resolution: ' + str(res[0]) + 'x' + str(res[1]))
-        return res
+        return fix_image_resolution(width, height, platform)
 
 
     # removes prompts that don't match user-specified base models
+    # single-pass dict rebuild; the old version wrapped the scan in an outer
+    # loop over a copy of the metadata, appending every unwanted key N times
     def filter_unwanted_base_prompts(self):
         if len(self.base_list) > 0:
-            self.log('Filtering out prompts that don''t match these base models: ' + str(self.base_list) + '...')
-            unwanted_keys = []
+            self.log('Filtering out prompts that don''t match these base models: ' + str(sorted(self.base_list)) + '...')
             original_length = len(self.metadata)
-            for kc, vc in self.metadata.copy().items():
-                for k, v in self.metadata.items():
-                    this_base = v.base_model.lower().strip()
-                    if this_base == '':
-                        this_base = 'unknown'
-                    if this_base not in self.base_list:
-                        # this is unwanted, save the key
-                        unwanted_keys.append(k)
-            for key in unwanted_keys:
-                # remove all saved keys
-                self.metadata.pop(key, None)
-            final_length = len(self.metadata)
-            num_unwanted = original_length - final_length
+            self.metadata = {k : v for k, v in self.metadata.items()
+                if (v.base_model.lower().strip() or 'unknown') in self.base_list}
+            num_unwanted = original_length - len(self.metadata)
             self.log('Removed ' + str(num_unwanted) + ' unwanted prompt(s)...')
 
 
@@ -396,6 +470,10 @@ class Prompts:
             dir = os.path.dirname(os.path.abspath(self.output_save_as))
             os.makedirs(dir, exist_ok = True)
             filename = self.output_save_as
+        # load optional header/footer once; they're written inline instead of
+        # re-reading and rewriting the whole output file afterwards
+        header = self.read_attachment(self.output_header, 'header')
+        footer = self.read_attachment(self.output_footer, 'footer')
         use_default = True
         if self.output_template != '':
             if exists(self.output_template):
@@ -403,186 +481,137 @@ class Prompts:
             else:
                 self.log('Error: specified prompt template file does not exist (' + self.output_template + '); using default!')
         if use_default:
-            self.write_default_prompt_file(filename)
+            self.write_default_prompt_file(filename, header, footer)
         else:
             template = ''
             with open(self.output_template, encoding = 'utf-8') as t:
                 template = t.read()
             self.log('Writing prompt metadata to disk using supplied template (' + self.output_template + '):')
-            f = open(filename, 'w', encoding = 'utf-8')
-            f.write('#######################################################################################################\n')
-            f.write('# ' + str(len(self.metadata)) + ' unique prompts from metadata extracted from civitai.com images.\n')
-            f.write('# Created on ' + dt.now().strftime('%Y-%m-%d') + ' at ' + dt.now().strftime('%H:%M:%S') + '.\n')
-            f.write('#######################################################################################################\n')
+            # build the output in memory and write it in one call
+            parts = []
+            if header != '':
+                parts.append(header)
+            parts.append('#######################################################################################################\n')
+            parts.append('# ' + str(len(self.metadata)) + ' unique prompts from metadata extracted from civitai.com images.\n')
+            parts.append('# Created on ' + dt.now().strftime('%Y-%m-%d') + ' at ' + dt.now().strftime('%H:%M:%S') + '.\n')
+            parts.append('#######################################################################################################\n')
             count = 0
             for k, v in self.metadata.items():
                 count += 1
-                t = template
-                ref = str(count).zfill(5)
-                # handle template replacements
-                t = utils.ireplace('[ref_num]', ref, t)
-                t = utils.ireplace('[filename]', v.orig_filename, t)
-                t = utils.ireplace('[filepath]', os.path.join(v.orig_filepath, v.orig_filename), t)
-                t = utils.ireplace('[raw_metadata]', v.raw_metadata.replace('\n', '\n#'), t)
-                t = utils.ireplace('[model]', v.model, t)
-                t = utils.ireplace('[seed]', str(v.seed), t)
-                t = utils.ireplace('[sampler]', v.sampler, t)
-                t = utils.ireplace('[clip_skip]', str(v.clip_skip), t)
-                t = utils.ireplace('[width]', str(v.width), t)
-                t = utils.ireplace('[height]', str(v.height), t)
-                t = utils.ireplace('[steps]', str(v.steps), t)
-                t = utils.ireplace('[scale]', str(v.scale), t)
-                t = utils.ireplace('[strength]', str(v.strength), t)
-                t = utils.ireplace('[neg_prompt]', v.neg_prompt, t)
-                t = utils.ireplace('[neg_prompt_raw]', v.neg_prompt_raw, t)
-                t = utils.ireplace('[prompt]', v.prompt, t)
-                t = utils.ireplace('[prompt_raw]', v.prompt_raw, t)
-                t = utils.ireplace('[base_model]', v.base_model, t)
-                t = utils.ireplace('[model_hash]', v.hash, t)
-                # write templated prompt to output file
-                f.write('\n' + t + '\n')
-            f.close()
+                # handle template replacements in a single pass; the old chain
+                # of ireplace calls re-scanned the whole template per token
+                repl = {
+                    'ref_num' : str(count).zfill(5),
+                    'filename' : v.orig_filename,
+                    'filepath' : os.path.join(v.orig_filepath, v.orig_filename),
+                    'raw_metadata' : v.raw_metadata.replace('\n', '\n#'),
+                    'model' : v.model,
+                    'seed' : str(v.seed),
+                    'sampler' : v.sampler,
+                    'clip_skip' : str(v.clip_skip),
+                    'width' : str(v.width),
+                    'height' : str(v.height),
+                    'steps' : str(v.steps),
+                    'scale' : str(v.scale),
+                    'strength' : str(v.strength),
+                    'neg_prompt' : v.neg_prompt,
+                    'neg_prompt_raw' : v.neg_prompt_raw,
+                    'prompt' : v.prompt,
+                    'prompt_raw' : v.prompt_raw,
+                    'base_model' : v.base_model,
+                    'model_hash' : v.hash
+                }
+                t = TEMPLATE_RE.sub(lambda m: repl[m.group(1).lower()], template)
+                # add templated prompt to the output buffer
+                parts.append('\n' + t + '\n')
+            if footer != '':
+                parts.append(footer)
+            with open(filename, 'w', encoding = 'utf-8') as f:
+                f.write(''.join(parts))
             self.log(str(len(self.metadata)) + ' prompts saved as ' + filename + '!')
-        # add header/footer to output if they were specified
-        self.attach_header_footer(filename)
 
 
     # writes a default Dream Factory .prompts file containing prompts discerned from image data
-    def write_default_prompt_file(self, filename):
+    def write_default_prompt_file(self, filename, header = '', footer = ''):
         self.log('Writing prompt metadata to disk using default template:')
-        f = open(filename, 'w', encoding = 'utf-8')
-        f.write('#######################################################################################################\n')
-        f.write('# ' + str(len(self.metadata)) + ' unique prompts from metadata extracted from civitai.com images.\n')
-        f.write('# Created on ' + dt.now().strftime('%Y-%m-%d') + ' at ' + dt.now().strftime('%H:%M:%S') + '.\n')
-        f.write('#######################################################################################################\n')
+        # build the output in memory and write it in one call
+        parts = []
+        if header != '':
+            parts.append(header)
+        parts.append('#######################################################################################################\n')
+        parts.append('# ' + str(len(self.metadata)) + ' unique prompts from metadata extracted from civitai.com images.\n')
+        parts.append('# Created on ' + dt.now().strftime('%Y-%m-%d') + ' at ' + dt.now().strftime('%H:%M:%S') + '.\n')
+        parts.append('#######################################################################################################\n')
         count = 0
         for k, v in self.metadata.items():
             count += 1
-            f.write('\n')
-            f.write('#######################################################################################################\n')
-            f.write('# PROMPT ' + str(count).zfill(5) + '\n')
-            f.write('# Extracted from: ' + v.orig_filename + '\n')
-            f.write('# Raw metadata below:\n#' + v.raw_metadata.replace('\n', '\n#') + '\n\n')
-            f.write('#######################################################################################################\n\n')
-            f.write('!FILENAME = ' + str(count).zfill(5) + '-' + self.prepend_filename + '\n')
-            f.write('#!CKPT_FILE = ' + v.model + '\n')
-            f.write('#!SEED = ' + str(v.seed) + '\n')
-            f.write('#!SAMPLER = ' + v.sampler + '\n')
-            f.write('#!CLIP_SKIP = ' + str(v.clip_skip) + '\n')
-            f.write('#!WIDTH = ' + str(v.width) + '\n')
-            f.write('#!HEIGHT = ' + str(v.height) + '\n')
-            f.write('!STEPS = ' + str(v.steps) + '\n')
-            f.write('!SCALE = ' + str(v.scale) + '\n')
-            f.write('\n!NEG_PROMPT = ' + v.neg_prompt + '\n')
-            f.write('\n' + v.prompt + '\n')
-        f.close()
+            parts.append('\n')
+            parts.append('#######################################################################################################\n')
+            parts.append('# PROMPT ' + str(count).zfill(5) + '\n')
+            parts.append('# Extracted from: ' + v.orig_filename + '\n')
+            parts.append('# Raw metadata below:\n#' + v.raw_metadata.replace('\n', '\n#') + '\n\n')
+            parts.append('#######################################################################################################\n\n')
+            parts.append('!FILENAME = ' + str(count).zfill(5) + '-' + self.prepend_filename + '\n')
+            parts.append('#!CKPT_FILE = ' + v.model + '\n')
+            parts.append('#!SEED = ' + str(v.seed) + '\n')
+            parts.append('#!SAMPLER = ' + v.sampler + '\n')
+            parts.append('#!CLIP_SKIP = ' + str(v.clip_skip) + '\n')
+            parts.append('#!WIDTH = ' + str(v.width) + '\n')
+            parts.append('#!HEIGHT = ' + str(v.height) + '\n')
+            parts.append('!STEPS = ' + str(v.steps) + '\n')
+            parts.append('!SCALE = ' + str(v.scale) + '\n')
+            parts.append('\n!NEG_PROMPT = ' + v.neg_prompt + '\n')
+            parts.append('\n' + v.prompt + '\n')
+        if footer != '':
+            parts.append(footer)
+        with open(filename, 'w', encoding = 'utf-8') as f:
+            f.write(''.join(parts))
         self.log(str(len(self.metadata)) + ' prompts saved as ' + filename + '!')
 
 
-    # attaches header & footer to given file, if specified
-    def attach_header_footer(self, filename):
-        header = ''
-        footer = ''
-        if self.output_header != '':
-            if exists(self.output_header):
-                with open(self.output_header, encoding = 'utf-8') as f:
-                    header = f.read()
-            else:
-                self.log('Error: specified output header file does not exist (' + self.output_header + '); ignoring it!')
-        if self.output_footer != '':
-            if exists(self.output_footer):
-                with open(self.output_footer, encoding = 'utf-8') as f:
-                    footer = f.read()
-            else:
-                self.log('Error: specified output footer file does not exist (' + self.output_footer + '); ignoring it!')
-
-        # if we have a valid non-empty header or footer, attach it to the given file
-        if header != '' or footer != '':
-            prompts = ''
-            if exists(filename):
-                # save the original file content
-                with open(filename, encoding = 'utf-8') as f:
-                    prompts = f.read()
-
-            # write the header, original content, and footer back to the file
-            with open(filename, 'w', encoding = 'utf-8') as f:
-                f.write(header)
-                f.write(prompts)
-                f.write(footer)
+    # returns the content of the given user-specified header/footer file,
+    # or '' if it wasn't specified or doesn't exist
+    def read_attachment(self, path, label):
+        if path != '':
+            if exists(path):
+                with open(path, encoding = 'utf-8') as f:
+                    return f.read()
+            self.log('Error: specified output ' + label + ' file does not exist (' + path + '); ignoring it!')
+        return ''
 
 
     # remove prompts that have a length under char_limit
     # lora references do not count against the limit
+    # (LORA_RE strips the refs in one pass; only the remaining length matters)
     def remove_empty(self, char_limit = 1):
         self.log('Removing prompts with less than ' + str(char_limit) + ' character(s):')
-        empty_keys = []
         original_length = len(self.metadata)
-
-        for k, v in self.metadata.items():
-            prompt = v.prompt.lower()
-            # remove lora references
-            while '<lora:' in prompt and '>' in prompt:
-                before = prompt.split('<lora:', 1)[0]
-                start_ref = prompt.split('<lora:', 1)[1]
-                after = start_ref.split('>', 1)[1]
-                prompt = before + after
-            if len(prompt.strip()) < char_limit:
-                # this prompt is too short, save the key
-                empty_keys.append(k)
-
-        for key in empty_keys:
-            # remove all saved keys
-            self.metadata.pop(key, None)
-        final_length = len(self.metadata)
-        num_empty = original_length - final_length
+        self.metadata = {k : v for k, v in self.metadata.items()
+            if len(LORA_RE.sub('', v.prompt.lower()).strip()) >= char_limit}
+        num_empty = original_length - len(self.metadata)
         self.log('Removed ' + str(num_empty) + ' prompt(s) that were too short...')
 
 
     # checks metadata for duplicate prompts and removes them
     # a prompt is considered a duplicate if the prompt/negative prompt pair
     # is identical to another after converting both to lowercase
+    # single hash-keyed pass (keep first, drop the rest) instead of the old
+    # nested scan, which compared & lowercased every pair of prompts
     def remove_dupes(self):
         self.log('Checking prompts for duplicates:')
-        dupe_keys = []
         original_length = len(self.metadata)
-        for kc, vc in tqdm(self.metadata.copy().items()):
-            for k, v in self.metadata.items():
-                if k != kc:
-                    if v.prompt.lower() == vc.prompt.lower() and v.neg_prompt.lower() == vc.neg_prompt.lower():
-                        # this is a dupe, save the key
-                        dupe_keys.append(k)
-        for key in dupe_keys:
-            # remove all saved keys
-            self.metadata.pop(key, None)
-        final_length = len(self.metadata)
-        num_dupes = original_length - final_length
+        seen = set()
+        survivors = {}
+        for k, v in self.metadata.items():
+            key = (v.prompt.lower(), v.neg_prompt.lower())
+            if key not in seen:
+                seen.add(key)
+                survivors[k] = v
+        self.metadata = survivors
+        num_dupes = original_length - len(self.metadata)
         self.log('Removed ' + str(num_dupes) + ' duplicate prompt(s)...')
 
 
-    # handles embedded AIR resources
-    # https://github.com/civitai/civitai/wiki/AIR-%E2%80%90-Uniform-Resource-Names-for-AI
-    # will replace the AIR link with the embedding name
-    def fix_embedding_refs(self):
-        self.log('Checking prompts for embedded URN references:')
-        count = 0
-        for k, v in tqdm(self.metadata.items()):
-            temp = v.prompt
-            v.prompt = self.replace_embedded_urns(v.prompt)
-            if temp != v.prompt:
-                count += 1
-                #print(v.orig_filename)
-                #print('\n\nOLD: ' + temp)
-                #print('\nNEW: ' + v.prompt)
-
-            temp = v.neg_prompt
-            v.neg_prompt = self.replace_embedded_urns(v.neg_prompt)
-            if temp != v.neg_prompt:
-                count += 1
-                #print('\n\nOLD: ' + temp)
-                #print('\nNEW: ' + v.neg_prompt)
-        self.log('Made ' + str(count) + ' URN link replacements...')
-
-
     # handles embedded URN AIR resources
     # https://github.com/civitai/civitai/wiki/AIR-%E2%80%90-Uniform-Resource-Names-for-AI
     # will replace the URN link with the embedding name and add the embedding to resource list
@@ -635,124 +664,15 @@ class Prompts:
         return text
 
 
-    # adds lora references that appears in resources metadata
-    # but are absent from the actual prompt
-    def add_missing_lora_refs(self):
-        self.log('Checking prompts for missing lora references:')
-        additions = 0
-        for k, v in self.metadata.items():
-            for r in v.resources:
-                if 'lora' in r.type and r.filename != '':
-                    # this reference is missing; add it
-                    lref = '<lora:' + r.filename.rsplit('.', 1)[0]
-                    if lref.lower() not in v.prompt.lower():
-                        v.prompt += ' ' + lref + ':' + str(r.weight) + '>'
-                        additions += 1
-        self.log('Added ' + str(additions) + ' lora reference(s) that were missing from prompts...')
-
-
-    # removes path references in prompt lora declarations
-    def fix_lora_refs(self):
-        self.log('Examining prompts for lora path references:')
-        replacements = 0
-        for k, v in self.metadata.items():
-            self.log('Working on ' + v.orig_filename + '...', False)
-            temp = v.prompt
-            while '<lora:' in temp and '>' in temp:
-                # this is inside a lora declaration
-                work = temp.split('<lora:', 1)[1].split('>', 1)[0]
-                # keep only the filename, remove paths
-                if '\\' in work:
-                    work = work.rsplit('\\', 1)[1]
-                    replacements += 1
-                if '/' in work:
-                    work = work.rsplit('/', 1)[1]
-                    replacements += 1
-                before = temp.split('<lora:', 1)[0]
-                after = temp.split('<lora:', 1)[1].split('>', 1)[1]
-                # added 2024-12-23 BK: prompts from civitai often have an
-                # extraneous space in lora declarations before the extension
-                while '. safetensors' in work:
-                    work = work.replace('. safetensors', '.safetensors')
-                temp = before + '<zzzora:' + work + '>' + after
-            v.prompt = temp.replace('<zzzora:', '<lora:')
-        self.log('Fixed ' + str(replacements) + ' lora reference(s) containing broken paths...')
-
-
     # handles translating non-Auto1111 recognized samplers to Auto1111 samplers
     def verify_sampler(self, sampler):
         sampler = sampler.lower().strip()
-        for a in self.auto1111_samplers:
-            if sampler == a.lower().strip():
-                return a
-
-        # didn't find exact match, try known subs:
-        if sampler == 'dpmpp_2m_sde_gpu':
-            return 'DPM++ 2M SDE'
-        elif sampler == 'dpmpp_2m_karras':
-            return 'DPM++ 2M'
-        elif sampler == 'dpmpp_3m_sde':
-            return 'DPM++ 3M SDE'
-        elif sampler == 'ddim_ddim_uniform':
-            return 'DDIM'
-        elif sampler == 'dpm++ 2m sde sgmuniform':
-            return 'DPM++ 2M SDE'
-        elif sampler == 'dpmpp_sde_karras':
-            return 'DPM++ SDE'
-        elif sampler == 'dpmpp_2s_ancestral_karras':
-            return 'DPM++ 2S a'
-        elif sampler == 'dpm++ 2m sde gpu':
-            return 'DPM++ 2M SDE'
-        elif sampler == 'dpmpp_3m_sde_gpu_karras':
-            return 'DPM++ 3M SDE'
-        elif sampler == 'dpmpp_2m_alt_karras':
-            return 'DPM++ 2M'
-        elif sampler == 'dpmpp_3m_sde_gpu':
-            return 'DPM++ 3M SDE'
-        elif sampler == 'euler_max':
-            return 'Euler'
-        elif sampler == 'dpmpp_2m_turbo':
-            return 'DPM++ 2M'
-        elif sampler == 'dpm++ 2m sde ays':
-            return 'DPM++ 2M SDE'
-        elif sampler == 'euler a turbo':
-            return 'Euler a'
-        elif sampler == 'dpmpp_sde_sgm_uniform':
-            return 'DPM++ SDE'
-        elif sampler == 'dpm++ 2m sgmuniform':
-            return 'DPM++ 2M'
-        elif sampler == 'dpmpp_3m_sde_karras':
-            return 'DPM++ 3M SDE'
-        elif sampler == 'dpmpp_2m_sde_karras':
-            return 'DPM++ 2M SDE'
-        elif sampler == 'ddim_sgm_uniform':
-            return 'DDIM'
-        elif sampler == 'dpm++ 2m turbo':
-            return 'DPM++ 2M'
-        elif sampler == 'dpmpp_sde':
-            return 'DPM++ SDE'
-        elif sampler == 'dpmpp_sde_gpu_karras':
-            return 'DPM++ SDE'
-        elif sampler == 'dpm_2_turbo':
-            return 'DPM2'
-        elif sampler == 'ddpm':
-            return 'DPM2'
-        elif sampler == 'euler_ancestral':
-            return 'Euler a'
-        elif sampler == 'dpmpp_3m_sde_gpu_sgm_uniform':
-            return 'DPM++ 3M SDE'
-        elif sampler == 'dpmpp_2m_sde_gpu_karras':
-            return 'DPM++ 2M SDE'
-        elif sampler == 'euler a sgmuniform':
-            return 'Euler a'
-        elif sampler == 'euler sgmuniform':
-            return 'Euler'
-        #elif sampler == 'sa solver':
-        #    return ''
-        else:
-            if sampler != '':
-                self.log('Warning: Couldn\'t find suitable sampler translation for ' + sampler + '; using default (DPM++ 2M)!', False)
-            return 'DPM++ 2M'
+        translated = SAMPLER_MAP.get(sampler)
+        if translated is not None:
+            return translated
+        if sampler != '':
+            self.log('Warning: Couldn\'t find suitable sampler translation for ' + sampler + '; using default (DPM++ 2M)!', False)
+        return 'DPM++ 2M'
 
 
     # handles logging to file/console
@@ -760,5 +680,14 @@ class Prompts:
         output = '[Prompts] > ' + str(line)
         if console:
             print(output)
-        with open(self.logfile, 'a', encoding="utf-8") as f:
-            f.write(output + '\n')
+        self._logf.write(output + '\n')
+        if console:
+            self._logf.flush()
+
+    # flushes & closes the log file handle
+    def close(self):
+        if not self._logf.closed:
+            self._logf.close()
+
+    def __del__(self):
+        self.close()
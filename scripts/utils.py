@@ -4,87 +4,164 @@
 import sys
 import os
 import re
-from collections import deque
+# the third-party regex module (if installed) compiles and matches faster
+# than stdlib re on the scan-heavy patterns below; same API, so fall back
+# to stdlib re when it's unavailable
+try:
+    import regex as re_engine
+except ImportError:
+    re_engine = re
+from functools import lru_cache
 from os.path import exists
 from pathlib import Path
 
+# translation table mapping filesystem-illegal filename characters to '-';
+# str.translate is a single C pass with no regex engine involved
+FILENAME_TABLE = str.maketrans({c : '-' for c in '/\\?%*:|"<>\x7f' + ''.join(chr(n) for n in range(0x20))})
+
+# deletes every character splitlines() treats as a line boundary, so
+# translate matches the old ''.join(p.splitlines()) in a single C pass
+NL_TABLE = str.maketrans('', '', '\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029')
+
+# patterns compiled once at import instead of per call; each one collapses
+# its artifact in a single scan, equivalent to the old repeated-replace loop
+# run to its fixed point:
+MULTI_SPACE_RE = re_engine.compile(r' {2,}')
+MULTI_COMMA_RE = re_engine.compile(r',{2,}')
+SPACE_COMMA_RE = re_engine.compile(r' +,')
+PERIOD_COMMA_RE = re_engine.compile(r'\.+,')
+PERIOD_SP_COMMA_RE = re_engine.compile(r'(?:\. )+,')
+COMMA_PERIOD_RE = re_engine.compile(r',\.+')
+COMMA_SP_PERIOD_RE = re_engine.compile(r',(?: \.)+')
+COMMA_SP_COMMA_RE = re_engine.compile(r',(?: ,)+')
+K_SPACE_RE = re_engine.compile(r'([48]) k')
+# a comma directly followed by a non-space character
+COMMA_SPACE_RE = re_engine.compile(r'(?<=[,])(?=[^\s])')
+# a period not followed by a space, digit, or the end of the string
+PERIOD_SPACE_RE = re_engine.compile(r'\.(?!\s|\d|$)')
+
+# matches anything sanitize_prompt could change: non-space whitespace,
+# the literal removals/replacements, or any substring one of the cleanup
+# patterns above would rewrite; deliberately conservative (a false hit
+# just takes the full pipeline), but no artifact can slip past it
+DIRTY_RE = re_engine.compile(
+    r'[^\S ]'            # newlines/tabs/other whitespace removed up front
+    r'|embedding:'
+    r'|BREAK'
+    r'|\(, \),|\(\)'
+    r'| {2}'             # multiple spaces
+    r'|,[^\s]'           # comma not followed by a space (includes ,, ,.)
+    r'| ,'               # space(s) before a comma
+    r'|, \.'             # comma space period
+    r'|\.(?!\s|\d|$)'    # period not followed by space/digit/end (includes .,)
+    r'|[48] k'
+)
+
+# matches one '--flag value' pair in a Dream Factory command; group 1 is the
+# flag name, group 2 everything up to the next flag (or end of string)
+FLAG_RE = re_engine.compile(r'--([A-Za-z][\w-]*)(.*?)(?=--|$)', re.DOTALL)
+
+# maps Dream Factory command-line flags to their params dict keys
+FLAG_KEY_MAP = {
+    'prompt' : 'prompt',
+    'neg_prompt' : 'neg_prompt',
+    'ckpt' : 'model',
+    'sampler' : 'sampler',
+    'ddim_steps' : 'steps',
+    'scale' : 'scale',
+    'seed' : 'seed',
+    'W' : 'width',
+    'H' : 'height',
+    'init-img' : 'input_image',
+    'strength' : 'strength',
+    'clip-skip' : 'clip_skip',
+    'styles' : 'styles'
+}
+
+# returns a compiled case-insensitive pattern matching the given literal text;
+# cached because callers replace the same few substrings repeatedly
+@lru_cache(maxsize = 1024)
+def ireplace_pattern(old):
+    return re_engine.compile(re.escape(old), re.IGNORECASE)
+
+# returns a compiled case-insensitive pattern matching the given filter word;
+# cached because the same short filter list is applied to every prompt
+@lru_cache(maxsize = 1024)
+def word_replace_pattern(word):
+    # the start/end of the string count as word boundaries alongside the
+    # explicit space/comma/paren/period classes (inside [...] the old ^ and $
+    # were literal characters, which is why trim fix-ups used to be needed)
+    return re_engine.compile("(?:^|(?<=[,\( ]))" + re.escape(word) + "(?=[\.,\) ]|$)", re.IGNORECASE)
+
 # for easy reading of prompt/config files
+# lines are read, stripped, and filtered lazily instead of materializing
+# the whole file up front; one line of lookahead keeps lines_remaining()
+# usable as a loop condition
 class TextFile():
     def __init__(self, filename):
-        self.lines = deque()
-        if exists(filename):
-            with open(filename, encoding = 'utf-8') as f:
-                l = f.readlines()
-
-            for x in l:
-                # remove newline and whitespace
-                x = x.strip('\n').strip();
-                # remove comments
-                x = x.split('#', 1)[0].strip();
+        self._iter = self._read_lines(filename) if exists(filename) else iter(())
+        self._next = next(self._iter, None)
+
+    # yields each non-empty line with comments and whitespace removed
+    def _read_lines(self, filename):
+        with open(filename, encoding = 'utf-8') as f:
+            for x in f:
+                # remove comments, newline and whitespace
+                x = x.partition('#')[0].strip()
                 if x != "":
                     # these lines are actual prompts
-                    self.lines.append(x)
+                    yield x
 
     def next_line(self):
-        return self.lines.popleft()
+        line = self._next
+        self._next = next(self._iter, None)
+        return line
 
     def lines_remaining(self):
-        return len(self.lines)
+        # at least one line is buffered; callers only test > 0
+        return 1 if self._next is not None else 0
 
 
 # given a filename, returns a filesystem-safe version with illegal chars replaced
 def sanitize_filename(filename):
-    safe_filename = re.sub(r"[/\\?%*:|\"<>\x7F\x00-\x1F]", "-", filename)
-    return safe_filename
+    return filename.translate(FILENAME_TABLE)
 
 
 # fixes common formatting issues in user prompts
 def sanitize_prompt(p):
+    # most prompts coming from disk are already clean; one scan for any
+    # dirty marker lets them skip the whole pipeline below
+    if not DIRTY_RE.search(p):
+        return p.strip(' ,')
     # remove newlines
-    split_text = p.splitlines()
-    p = ''.join(split_text)
+    p = p.translate(NL_TABLE)
     # remove explicit embedding declarations
     p = p.replace('embedding:', '')
     # ensure spaces around BREAK declarations; extras will be removed below
     p = p.replace('BREAK', ' BREAK ')
     # remove common readability/formatting issues
+    # (these two can re-create themselves when removed, so loop to a fixed point)
     while '(, ),' in p:
         p = p.replace('(, ),', '')
     while '()' in p:
         p = p.replace('()', '')
-    while '  ' in p:
-        p = p.replace('  ', ' ')
-    while ',,' in p:
-        p = p.replace(',,', ',')
-    while ' ,' in p:
-        p = p.replace(' ,', ',')
-    while '.,' in p:
-        p = p.replace('.,', ',')
-    while '. ,' in p:
-        p = p.replace('. ,', ',')
-    while ',.' in p:
-        p = p.replace(',.', ',')
-    while ', .' in p:
-        p = p.replace(', .', ',')
-    while ', ,' in p:
-        p = p.replace(', ,', ',')
-    while '8 k' in p:
-        p = p.replace('8 k', '8k')
-    while '4 k' in p:
-        p = p.replace('4 k', '4k')
-    # regex to force a space after commas and periods (except in decimal #s)
-    #p = re.sub(r'(?<=[.,])(?=[^\s])', r' ', p).strip()
-    p = re.sub(r'(?<=[,])(?=[^\s])', r' ', p).strip()
-    p = re.sub('\.(?!\s|\d|$)', '. ', p).strip()
-    while ', ,' in p:
-        p = p.replace(', ,', ',')
-    # remove leading spaces and commas
-    while p.startswith(' ') or p.startswith(','):
-        p = p[1:]
-    # remove trailing spaces and commas
-    while p.endswith(' ') or p.endswith(','):
-        p = p[:-1]
-    return p
+    # each of these collapses its artifact in one scan; the order matches the
+    # old replace loops exactly
+    p = MULTI_SPACE_RE.sub(' ', p)
+    p = MULTI_COMMA_RE.sub(',', p)
+    p = SPACE_COMMA_RE.sub(',', p)
+    p = PERIOD_COMMA_RE.sub(',', p)
+    p = PERIOD_SP_COMMA_RE.sub(',', p)
+    p = COMMA_PERIOD_RE.sub(',', p)
+    p = COMMA_SP_PERIOD_RE.sub(',', p)
+    p = COMMA_SP_COMMA_RE.sub(',', p)
+    p = K_SPACE_RE.sub(r'\1k', p)
+    # force a space after commas and periods (except in decimal #s)
+    p = COMMA_SPACE_RE.sub(r' ', p).strip()
+    p = PERIOD_SPACE_RE.sub('. ', p).strip()
+    p = COMMA_SP_COMMA_RE.sub(',', p)
+    # remove leading/trailing spaces and commas
+    return p.strip(' ,')
 
 
 # case-insensitive word replace
@@ -94,52 +171,43 @@ def sanitize_prompt(p):
 def word_replace(word, text):
     if word.lower().strip() == text.lower().strip():
         return ''
-
-    final = text
-    # this should be all that's required; not sure why the ^ $ aren't matching start/end of string...
-    final = re.sub("(?<=[,\( ^])" + re.escape(word) + "(?=[\.,\) $])", "", text, flags=re.IGNORECASE)
-
-    if final.lower().strip().startswith(word.lower().strip()):
-        final = final[len(word):]
-
-    if final.lower().strip().endswith(word.lower().strip()):
-        final = final[:0-len(word)]
-
-    return final
+    # the pattern now handles words at the start/end of the string itself,
+    # so no trim fix-ups are needed after the sub
+    return word_replace_pattern(word).sub("", text)
 
 
 # case-insensitive replace
+# one linear regex scan; the old loop lowercased and rebuilt the whole
+# string once per match
 def ireplace(old, new, text):
-    idx = 0
-    while idx < len(text):
-        index_l = text.lower().find(old.lower(), idx)
-        if index_l == -1:
-            return text
-        text = text[:index_l] + new + text[index_l + len(old):]
-        idx = index_l + len(new)
-    return text
+    # lambda replacement so backslashes in new aren't treated as escapes
+    return ireplace_pattern(old).sub(lambda m: new, text)
 
 
 # for EXIF metadata formatted by Dream Factory,
+# splits a full model identifier string into its (filename, hash) parts
+# in one pass; callers usually need both, and the old per-part helpers
+# each re-split the same identifier
+# cached because the same handful of model IDs repeats across every image
+@lru_cache(maxsize = 8192)
+def parse_model_id(model_id):
+    filename, _, rest = model_id.partition('[')
+    hash = rest.partition(']')[0].strip() if ']' in rest else ''
+    base = os.path.basename(filename.strip())
+    # splitext finds the extension in one pass and avoids the magic
+    # slice length that the old endswith/[:-12] pair relied on
+    root, ext = os.path.splitext(base)
+    return (root if ext == '.safetensors' else base), hash
+
+
 # extracts model filename from full identifier string
 def extract_model_filename(model_id):
-    filename = model_id
-    if '[' in filename:
-        filename = filename.split('[', 1)[0].strip()
-    filename = os.path.basename(filename)
-    if filename.endswith('.safetensors'):
-        filename = filename[:-12]
-    return filename
+    return parse_model_id(model_id)[0]
 
 
-# for EXIF metadata formatted by Dream Factory,
 # extracts model hash from full identifier string if present
 def extract_model_hash(model_id):
-    hash = ''
-    if '[' in model_id and ']' in model_id:
-        hash = model_id.split('[', 1)[1].strip()
-        hash = hash.split(']', 1)[0].strip()
-    return hash
+    return parse_model_id(model_id)[1]
 
 
 # for EXIF metadata formatted by Dream Factory,
@@ -165,99 +233,36 @@ def extract_params_from_command(command):
         command = command.strip('"')
 
         # need this because of old format w/ upscale info included
-        if '(upscaled' in command:
-            command = command.split('(upscaled', 1)[0]
-            command = command.replace('(upscaled', '')
-
-        if '--prompt' in command:
-            temp = command.split('--prompt', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            params.update({'prompt' : temp.strip().strip('"')})
-
-        else:
+        # (partition finds and truncates in one scan; empty tail if absent)
+        command = command.partition('(upscaled')[0]
+
+        # pull every recognized --flag/value pair out in a single scan
+        # (the old version re-split the full command once per flag)
+        found_prompt = False
+        for m in FLAG_RE.finditer(command):
+            key = FLAG_KEY_MAP.get(m.group(1))
+            if key is None:
+                continue
+            temp = m.group(2).strip()
+            if key == 'prompt' or key == 'neg_prompt' or key == 'model':
+                temp = temp.strip('"')
+            elif key == 'input_image':
+                temp = temp.replace('../', '').strip().strip('"')
+                head, tail = os.path.split(temp)
+                if tail == '':
+                    tail = temp
+                temp = tail
+            params[key] = temp
+            if key == 'prompt':
+                found_prompt = True
+
+        if not found_prompt:
             # we'll assume anything before --ddim_steps is the prompt
-            temp = command.split('--ddim_steps', 1)[0]
+            temp = command.partition('--ddim_steps')[0]
             temp = temp.strip()
             if temp is not None and len(temp) > 0 and temp[-1] == '\"':
                 temp = temp[:-1]
             temp = temp.replace('\\', '')
-            params.update({'prompt' : temp})
-
-        if '--neg_prompt' in command:
-            temp = command.split('--neg_prompt', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            params.update({'neg_prompt' : temp.strip().strip('"')})
-
-        if '--ckpt' in command:
-            temp = command.split('--ckpt', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            params.update({'model' : temp.strip().strip('"')})
-
-        if '--sampler' in command:
-            temp = command.split('--sampler', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            params.update({'sampler' : temp.strip()})
-
-        if '--ddim_steps' in command:
-            temp = command.split('--ddim_steps', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            params.update({'steps' : temp.strip()})
-
-        if '--scale' in command:
-            temp = command.split('--scale', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            params.update({'scale' : temp.strip()})
-
-        if '--seed' in command:
-            temp = command.split('--seed', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            params.update({'seed' : temp.strip()})
-
-        if '--W' in command:
-            temp = command.split('--W', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            params.update({'width' : temp.strip()})
-
-        if '--H' in command:
-            temp = command.split('--H', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            params.update({'height' : temp.strip()})
-
-        if '--init-img' in command:
-            temp = command.split('--init-img', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            temp = temp.replace('../', '').strip().strip('"')
-            head, tail = os.path.split(temp)
-            if tail == '':
-                tail = temp
-            params.update({'input_image' : tail})
-
-        if '--strength' in command:
-            temp = command.split('--strength', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            params.update({'strength' : temp.strip()})
-
-        if '--clip-skip' in command:
-            temp = command.split('--clip-skip', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            params.update({'clip_skip' : temp.strip()})
-
-        if '--styles' in command:
-            temp = command.split('--styles', 1)[1]
-            if '--' in temp:
-                temp = temp.split('--', 1)[0]
-            params.update({'styles' : temp.strip()})
+            params['prompt'] = temp
 
     return params